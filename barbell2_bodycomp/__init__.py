@@ -2,8 +2,31 @@ __author__ = 'Ralph Brecheisen'
 __email__ = 'r.brecheisen@maastrichtuniversity.nl'
 __version__ = '0.27.0'
 
-from barbell2_bodycomp.calculator import BodyCompositionCalculator
-from barbell2_bodycomp.seg import MuscleFatSegmentator
-from barbell2_bodycomp.selectroi import RoiSelector
-from barbell2_bodycomp.selectslice import SliceSelector
-from barbell2_bodycomp.totalseg import TotalSegmentator
+import importlib
+
+# Public classes are imported on first access so that importing the package (or one of its
+# lightweight modules) does not pull in pandas, nibabel, TensorFlow, etc.
+_lazy_imports = {
+    'BodyCompositionCalculator': 'barbell2_bodycomp.calculator',
+    'L3Pipeline': 'barbell2_bodycomp.pipeline',
+    'MuscleFatSegmentator': 'barbell2_bodycomp.seg',
+    'RoiSelector': 'barbell2_bodycomp.selectroi',
+    'SegmentationStore': 'barbell2_bodycomp.segstore',
+    'SliceSelector': 'barbell2_bodycomp.selectslice',
+    'TotalSegmentator': 'barbell2_bodycomp.totalseg',
+    'TotalSegmentatorBatch': 'barbell2_bodycomp.totalseg',
+}
+
+__all__ = list(_lazy_imports.keys())
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+
+class ArtifactCache:
+    """ Local content-addressed store for outputs of external tools (dcm2niix, TotalSegmentator).
+    Entries are keyed by a hash of the input files' contents plus the command flags. On a hit the
+    cached output is hardlinked (or copied if link=False or hardlinks are not possible) into place.
+    Hardlinked outputs share their data with the store, so tools must delete rather than overwrite
+    them. The store is bounded by max_size_bytes and evicts least recently used entries.
+    """
+    DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'barbell2_bodycomp', 'artifacts')
+
+    def __init__(self, directory=None, max_size_bytes=50 * 1024 ** 3, link=True, logger=None):
+        self.directory = directory or ArtifactCache.DEFAULT_DIRECTORY
+        self.max_size_bytes = max_size_bytes
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def hash_path(path, h=None):
+        """ Hashes the contents of a file or of all files in a directory (including their relative paths) """
+        h = h or hashlib.sha256()
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            return h
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                f_path = os.path.join(root, f)
+                h.update(os.path.relpath(f_path, path).encode('utf-8'))
+                ArtifactCache.hash_path(f_path, h)
+        return h
+
+    def get_key(self, input_paths, flags):
+        h = hashlib.sha256(json.dumps(flags, sort_keys=True).encode('utf-8'))
+        for input_path in input_paths:
+            self.hash_path(input_path, h)
+        return h.hexdigest()
+
+    def get_entry_directory(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    @staticmethod
+    def get_size(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        size = 0
+        for root, _, files in os.walk(path):
+            for f in files:
+                size += os.path.getsize(os.path.join(root, f))
+        return size
+
+    @staticmethod
+    def link_or_copy(src, dst, link=True):
+        if os.path.isdir(src):
+            os.makedirs(dst, exist_ok=True)
+            for item in os.listdir(src):
+                ArtifactCache.link_or_copy(os.path.join(src, item), os.path.join(dst, item), link)
+            return
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.get_entry_directory(key), 'data'))
+
+    def get(self, key, output_path):
+        """ Places the cached output for key at output_path. Returns True on a hit, False on a miss """
+        entry_directory = self.get_entry_directory(key)
+        data_path = os.path.join(entry_directory, 'data')
+        if not os.path.exists(data_path):
+            self.misses += 1
+            return False
+        parent_directory = os.path.dirname(output_path)
+        if parent_directory:
+            os.makedirs(parent_directory, exist_ok=True)
+        self.link_or_copy(data_path, output_path, self.link)
+        # Modification time of the entry's meta file is used as its last access time
+        os.utime(os.path.join(entry_directory, 'meta.json'))
+        self.hits += 1
+        return True
+
+    def put(self, key, output_path):
+        """ Stores output_path (file or directory) under key and evicts old entries if needed """
+        entry_directory = self.get_entry_directory(key)
+        if os.path.exists(entry_directory):
+            return
+        os.makedirs(os.path.dirname(entry_directory), exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(prefix=f'.{key}.', dir=os.path.dirname(entry_directory))
+        try:
+            # Always copy into the store so later changes to the output cannot affect the entry
+            self.link_or_copy(output_path, os.path.join(tmp_directory, 'data'), link=False)
+            with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+                json.dump({'size': self.get_size(output_path), 'created': time.time()}, f)
+            os.rename(tmp_directory, entry_directory)
+        except OSError:
+            # Another process stored the same entry first
+            if not os.path.isdir(entry_directory):
+                raise
+        finally:
+            if os.path.isdir(tmp_directory):
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+        self.evict()
+
+    def get_entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for prefix in os.listdir(self.directory):
+            prefix_directory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_directory):
+                continue
+            for key in os.listdir(prefix_directory):
+                meta_file = os.path.join(prefix_directory, key, 'meta.json')
+                if key.startswith('.') or not os.path.isfile(meta_file):
+                    continue
+                try:
+                    with open(meta_file, 'r') as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(meta_file), size, key))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def evict(self):
+        """ Removes least recently used entries until the store fits in max_size_bytes """
+        entries = sorted(self.get_entries())
+        total_size = sum([size for _, size, _ in entries])
+        for _, size, key in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            self.logger.info(f'Evicting artifact {key} ({size} bytes)')
+            shutil.rmtree(self.get_entry_directory(key), ignore_errors=True)
+            total_size -= size
+
+    def stats(self):
+        entries = self.get_entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'size_bytes': sum([size for _, size, _ in entries]),
+        }
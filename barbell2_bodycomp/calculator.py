@@ -1,10 +1,12 @@
 import os
 import logging
+import concurrent.futures
 import pydicom
 import numpy as np
-import pandas as pd
 
-from barbell2_bodycomp.utils import calculate_area, calculate_mean_radiation_attenuation, get_pixels
+from barbell2_bodycomp.segstore import SegmentationStore
+from barbell2_bodycomp.utils import calculate_label_metrics, calculate_probability_metrics, get_pixels, \
+    is_probability_file, load_probabilities
 
 
 class BodyCompositionCalculator:
@@ -13,11 +15,29 @@ class BodyCompositionCalculator:
     VAT = 5
     SAT = 7
 
+    TISSUES = {'muscle': MUSCLE, 'vat': VAT, 'sat': SAT}
+    METRICS = ['area', 'ra', 'ra_std', 'pixel_count']
+    SOFT_METRICS = ['area', 'ra']
+
+    # Label and HU range of each sub-area, reported as '<name>_area' (area of the label within the range)
+    HU_RANGES = {
+        'muscle_hu': (MUSCLE, -29, 150),
+        'imat': (MUSCLE, -190, -30),
+        'vat_hu': (VAT, -150, -50),
+        'sat_hu': (SAT, -190, -30),
+    }
+
+    # Labels corresponding to the channels of MuscleFatSegmentator probability maps
+    PROBABILITY_LABELS = [0, MUSCLE, VAT, SAT]
+    SEGMENTATION_FILE_EXTENSIONS = ['.seg.npy', '.seg.prob.npy', '.seg.prob.npz']
+
     def __init__(self, logger=None):
         self.input_files = None                 # L3 images
         self.input_segmentation_files = None    # Segmentations calculated using MuscleFatSegmentator
+        self.input_segmentation_store = None    # (Optional) SegmentationStore directory with segmentations
         self.heights = None                     # (Optional) dictionary containing heights for each L3 image
         self.output_metrics = None              # Dictionary containing output metrics for each L3 image
+        self.workers = 1                        # Number of processes used for loading and calculating metrics
         if logger:
             self.logger = logger
         else:
@@ -32,69 +52,116 @@ class BodyCompositionCalculator:
 
     @staticmethod
     def load_segmentation(f_path):
+        if isinstance(f_path, tuple):
+            # (store directory, name) pairs are read from the store's memory map without copying
+            return SegmentationStore.get(f_path[0]).get_labels(f_path[1])
+        if is_probability_file(f_path):
+            return load_probabilities(f_path)
         return np.load(f_path)
 
+    @staticmethod
+    def calculate_metrics(image, segmentations, pixel_spacing, hu_ranges=None):
+        """ Calculates metrics from a label map (H, W) or a probability map (H, W, C). For probability
+        maps, metrics of the argmax label map are complemented with soft metrics ('<tissue>_<metric>_soft').
+        HU-gated sub-areas use hu_ranges (default HU_RANGES) of name to (label, min HU, max HU), pass an
+        empty dictionary to skip them
+        """
+        if hu_ranges is None:
+            hu_ranges = BodyCompositionCalculator.HU_RANGES
+        probabilities = None
+        if segmentations.ndim == 3:
+            probabilities = segmentations
+            labels = np.asarray(BodyCompositionCalculator.PROBABILITY_LABELS, dtype=np.uint8)
+            segmentations = labels[probabilities.argmax(axis=-1)]
+        label_metrics = calculate_label_metrics(
+            image, segmentations, pixel_spacing, {name: hu_range[1:] for name, hu_range in hu_ranges.items()})
+        metrics = {}
+        for metric in BodyCompositionCalculator.METRICS:
+            for tissue, label in BodyCompositionCalculator.TISSUES.items():
+                metrics[f'{tissue}_{metric}'] = label_metrics[label][metric] if label in label_metrics else 0.0
+        for name, (label, _, _) in hu_ranges.items():
+            metrics[f'{name}_area'] = label_metrics[label][f'{name}_area'] if label in label_metrics else 0.0
+        if probabilities is not None:
+            channel_metrics = calculate_probability_metrics(image, probabilities, pixel_spacing)
+            channels = BodyCompositionCalculator.PROBABILITY_LABELS
+            for metric in BodyCompositionCalculator.SOFT_METRICS:
+                for tissue, label in BodyCompositionCalculator.TISSUES.items():
+                    metrics[f'{tissue}_{metric}_soft'] = channel_metrics[channels.index(label)][metric]
+        return metrics
+
+    @classmethod
+    def calculate_metrics_for_file_pair(cls, file_pair):
+        image, pixel_spacing = cls.load_dicom(file_pair[0])
+        segmentations = cls.load_segmentation(file_pair[1])
+        return cls.calculate_metrics(image, segmentations, pixel_spacing)
+
+    def get_file_pairs(self):
+        segmentation_files = {}
+        for input_segmentation_file in self.input_segmentation_files or []:
+            segmentation_files.setdefault(os.path.split(input_segmentation_file)[1], input_segmentation_file)
+        store = None
+        if self.input_segmentation_store is not None:
+            store = SegmentationStore.get(self.input_segmentation_store, self.logger)
+            store.load_index()
+        file_pairs = []
+        for input_file in self.input_files:
+            input_file_name = os.path.split(input_file)[1]
+            input_segmentation_file = None
+            for extension in BodyCompositionCalculator.SEGMENTATION_FILE_EXTENSIONS:
+                input_segmentation_file = segmentation_files.get(input_file_name + extension)
+                if input_segmentation_file is not None:
+                    break
+            if input_segmentation_file is None and store is not None and input_file_name in store:
+                input_segmentation_file = (self.input_segmentation_store, input_file_name)
+            if input_segmentation_file is None:
+                self.logger.warning(f'Input file {input_file_name} missing corresponding segmentation file')
+                continue
+            file_pairs.append((input_file, input_segmentation_file))
+        return file_pairs
+
+    def iterate_metrics(self, file_pairs):
+        """ Yields (file pair, metrics) in the order of file_pairs, using a process pool if workers > 1 """
+        if self.workers is None or self.workers <= 1 or len(file_pairs) <= 1:
+            for file_pair in file_pairs:
+                yield file_pair, self.calculate_metrics_for_file_pair(file_pair)
+            return
+        chunk_size = max(1, len(file_pairs) // (self.workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for file_pair, metrics in zip(
+                    file_pairs, executor.map(self.calculate_metrics_for_file_pair, file_pairs, chunksize=chunk_size)):
+                yield file_pair, metrics
+
     def execute(self):
         # TODO: If heights are provided, output index values!!!
         self.logger.info('Running BodyCompositionCalculator...')
         if self.input_files is None:
             self.logger.error('Input files not specified')
             return None
-        if self.input_segmentation_files is None:
+        if self.input_segmentation_files is None and self.input_segmentation_store is None:
             self.logger.error('Input segmentation files not specified')
             return None
-        # Check that we're not dealing with probability maps
-        if self.input_segmentation_files[0].endswith('.seg.prob.npy'):
-            self.logger.error('Cannot handle *.seg.prob.npy files')
-            return None
         # Check that for each input file we have a matching segmentation file
-        file_pairs = []
-        for input_file in self.input_files:
-            input_file_name = os.path.split(input_file)[1]
-            found = False
-            for input_segmentation_file in self.input_segmentation_files:
-                input_segmentation_file_name = os.path.split(input_segmentation_file)[1]
-                if input_file_name + '.seg.npy' == input_segmentation_file_name:
-                    file_pairs.append((input_file, input_segmentation_file))
-                    found = True
-                    break
-            if not found:
-                self.logger.warn(f'Input file {input_file_name} missing corresponding segmentation file')
+        file_pairs = self.get_file_pairs()
         # Work with found file pairs
         self.output_metrics = {}
-        for file_pair in file_pairs:
-            image, pixel_spacing = self.load_dicom(file_pair[0])
-            segmentations = self.load_segmentation(file_pair[1])
-            self.output_metrics[file_pair[0]] = {}
-            self.output_metrics[file_pair[0]] = {
-                'muscle_area': calculate_area(segmentations, BodyCompositionCalculator.MUSCLE, pixel_spacing),
-                'vat_area': calculate_area(segmentations, BodyCompositionCalculator.VAT, pixel_spacing),
-                'sat_area': calculate_area(segmentations, BodyCompositionCalculator.SAT, pixel_spacing),
-                'muscle_ra': calculate_mean_radiation_attenuation(image, segmentations, BodyCompositionCalculator.MUSCLE),
-                'vat_ra': calculate_mean_radiation_attenuation(image, segmentations, BodyCompositionCalculator.VAT),
-                'sat_ra': calculate_mean_radiation_attenuation(image, segmentations, BodyCompositionCalculator.SAT),
-            }
+        for file_pair, metrics in self.iterate_metrics(file_pairs):
+            self.output_metrics[file_pair[0]] = metrics
             self.logger.info(f'{file_pair[0]}:')
-            self.logger.info(' - muscle_area: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
-            self.logger.info(' - vat_area: {}'.format(self.output_metrics[file_pair[0]]['vat_area']))
-            self.logger.info(' - sat_area: {}'.format(self.output_metrics[file_pair[0]]['sat_area']))
-            self.logger.info(' - muscle_ra: {}'.format(self.output_metrics[file_pair[0]]['muscle_ra']))
-            self.logger.info(' - vat_ra: {}'.format(self.output_metrics[file_pair[0]]['vat_ra']))
-            self.logger.info(' - sat_ra: {}'.format(self.output_metrics[file_pair[0]]['sat_ra']))
+            for k, v in metrics.items():
+                self.logger.info(f' - {k}: {v}')
         return self.output_metrics
     
     def as_df(self):
+        import pandas as pd
         if self.output_metrics is None:
             return None
-        data = {'file': [], 'muscle_area': [], 'vat_area': [], 'sat_area': [], 'muscle_ra': [], 'vat_ra': [], 'sat_ra': []}
-        for k in self.output_metrics.keys():
-            data['file'].append(k)
-            data['muscle_area'].append(self.output_metrics[k]['muscle_area'])
-            data['vat_area'].append(self.output_metrics[k]['vat_area'])
-            data['sat_area'].append(self.output_metrics[k]['sat_area'])
-            data['muscle_ra'].append(self.output_metrics[k]['muscle_ra'])
-            data['vat_ra'].append(self.output_metrics[k]['vat_ra'])
-            data['sat_ra'].append(self.output_metrics[k]['sat_ra'])
+        # Files with probability maps have more metrics, so collect all metric names first
+        metric_names = {}
+        for metrics in self.output_metrics.values():
+            metric_names.update(dict.fromkeys(metrics.keys()))
+        data = {'file': list(self.output_metrics.keys())}
+        for metric in metric_names:
+            data[metric] = [metrics.get(metric) for metrics in self.output_metrics.values()]
         return pd.DataFrame(data=data)
 
 
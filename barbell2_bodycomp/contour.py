@@ -1,99 +1,315 @@
-import cv2
+import os
+import json
+import concurrent.futures
 import pydicom
 import numpy as np
-import matplotlib.pyplot as plt
 
 if __name__ != '__main__':
-    from barbell2_bodycomp.utils import apply_window
+    from barbell2_bodycomp.calculator import BodyCompositionCalculator
+    from barbell2_bodycomp.utils import apply_window, is_probability_file, load_probabilities, read_dicom_header
 
 
 class AbdominalCircumferenceCalculator:
 
     def __init__(self):
         self.input_files = None
+        self.input_segmentation_files = None    # (Optional) segmentations (*.seg.npy) to use as body mask
+        self.mask_labels = None                 # (Optional) labels that make up the mask, default all non-zero
+        self.workers = 1
         self.circumference_values = {}
 
     @staticmethod
     def calculate_circumference(image, pixel_spacing):
+        """ Returns the perimeter (mm) of the largest external contour of the non-zero pixels in the
+        uint8 image, including the segment that closes the contour
+        """
+        import cv2
         contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
         if len(contours) == 0:
             return 0
         longest_contour = max(contours, key=cv2.contourArea)
-        circumference_mm = 0
-        for i in range(len(longest_contour) - 1):
-            pt1 = longest_contour[i+0][0]
-            pt2 = longest_contour[i+1][0]
-            dx = (pt2[0] - pt1[0]) * pixel_spacing[0]
-            dy = (pt2[1] - pt1[1]) * pixel_spacing[1]
-            distance = np.sqrt(dx**2 + dy**2)
-            circumference_mm += distance
-        return circumference_mm    
-
-    def get_normalized_image(self, p):
+        points = longest_contour[:, 0, :].astype(np.float64)
+        d = np.diff(points, axis=0, append=points[:1])
+        # Contour points are (x, y) and PixelSpacing is (row spacing, column spacing)
+        d[:, 0] *= float(pixel_spacing[1])
+        d[:, 1] *= float(pixel_spacing[0])
+        return float(np.sqrt(np.einsum('ij,ij->i', d, d)).sum())
+
+    @staticmethod
+    def get_normalized_image(p):
         image = p.pixel_array
         window = (400, 50)
         image = p.RescaleSlope * image + p.RescaleIntercept
         image = apply_window(image, window)
         return image
 
+    @staticmethod
+    def get_mask(segmentation_file, mask_labels=None):
+        if is_probability_file(segmentation_file):
+            # Map channel indices to segmentation labels so mask_labels means the same for both file types
+            channel_labels = np.asarray(BodyCompositionCalculator.PROBABILITY_LABELS, dtype=np.uint8)
+            labels = channel_labels[load_probabilities(segmentation_file).argmax(axis=-1)]
+        else:
+            labels = np.load(segmentation_file)
+        if mask_labels is None:
+            mask = labels != 0
+        else:
+            mask = np.isin(labels, mask_labels)
+        return mask.astype(np.uint8)
+
+    @classmethod
+    def calculate_circumference_for_file(cls, f, segmentation_file=None, mask_labels=None):
+        if segmentation_file is not None:
+            # Reuse the segmentation instead of thresholding the CT image, only the pixel spacing is needed
+            pixel_spacing = read_dicom_header(f, ['PixelSpacing']).PixelSpacing
+            image = cls.get_mask(segmentation_file, mask_labels)
+        else:
+            p = pydicom.dcmread(f)
+            pixel_spacing = p.PixelSpacing
+            # Windowed image is in [0, 1] so it can be scaled directly instead of renormalized
+            image = (cls.get_normalized_image(p) * 255).astype(np.uint8)
+        return cls.calculate_circumference(image, pixel_spacing)
+
+    def get_segmentation_files(self):
+        segmentation_files = {}
+        if self.input_segmentation_files is not None:
+            for segmentation_file in self.input_segmentation_files:
+                file_name = os.path.split(segmentation_file)[1]
+                for extension in ['.seg.npy', '.seg.prob.npy', '.seg.prob.npz']:
+                    if file_name.endswith(extension):
+                        segmentation_files.setdefault(file_name[:-len(extension)], segmentation_file)
+        return [segmentation_files.get(os.path.split(f)[1]) for f in self.input_files]
+
     def execute(self):
         self.circumference_values = {}
-        for f in self.input_files:
-            p = pydicom.dcmread(f)
-            image = self.get_normalized_image(p)            
-            if image.dtype != np.uint8:
-                image = ((image - np.min(image)) / (np.max(image) - np.min(image)) * 255).astype('uint8')
-            circumference_mm = self.calculate_circumference(image, p.PixelSpacing)
-            self.circumference_values[f] = circumference_mm
+        segmentation_files = self.get_segmentation_files()
+        mask_labels = [self.mask_labels] * len(self.input_files)
+        if self.workers is None or self.workers <= 1 or len(self.input_files) <= 1:
+            results = map(self.calculate_circumference_for_file, self.input_files, segmentation_files, mask_labels)
+            for f, circumference_mm in zip(self.input_files, results):
+                self.circumference_values[f] = circumference_mm
+            return self.circumference_values
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(
+                self.calculate_circumference_for_file, self.input_files, segmentation_files, mask_labels,
+                chunksize=max(1, len(self.input_files) // (self.workers * 4)))
+            for f, circumference_mm in zip(self.input_files, results):
+                self.circumference_values[f] = circumference_mm
         return self.circumference_values
 
 
 class AbdominalCircumferenceEstimator:
-    """ Class that takes L3 image as input and estimates the abdominal circumference in cm's
+    """ Class that takes L3 image as input and estimates the abdominal circumference in mm
     even if the abdomen is partially occluded or clipped by a FOV that is too small. This
-    can easily happen with obese patients. 
-    Estimator takes an optional contour estimation model that is able to exclude the arms in
-    the image (if present) and only output the abdomen
+    can easily happen with obese patients.
+    The estimator completes the visible body contour with an ellipse fitted to its unclipped
+    points and corrects the result with a small ridge regression on contour features. Training
+    uses occlusion augmentation so unclipped images with known circumferences are enough
     """
+    FEATURE_NAMES = ['bias', 'perimeter', 'visible_perimeter', 'ellipse_perimeter', 'clipped_length', 'sqrt_area']
+
     def __init__(self):
         self.input_files = None
         self.input_target_labels = None
-        self.circumference_estimation_model = None
-        self.circumference_estimation_model_params = None
-
-    def add_random_occlusion(image, rectangle_width):
-        if rectangle_width == 0:
-            rectangle_width = 1
-        image[:, :rectangle_width] = 0
-        image[:, -rectangle_width:] = 0    
-        return image
+        self.circumference_estimation_model = None          # Dictionary with feature names and coefficients
+        self.circumference_estimation_model_params = None   # Training/validation errors of the model
+        self.nr_augmentations = 4           # Number of randomly occluded copies of each training image
+        self.max_occlusion_fraction = 0.25  # Maximum width of occlusion on each side, as fraction of image width
+        self.test_fraction = 0.2
+        self.ridge = 1e-3
+        self.batch_size = 64
+        self.random_state = 0
+        self.circumference_values = {}
+
+    @staticmethod
+    def add_random_occlusion(images, rectangle_widths, out=None):
+        """ Zeroes rectangle_widths[i] columns on the left and right side of images[i] for a stack
+        of (N, H, W) images. Pass out=images to occlude in place
+        """
+        images = np.asarray(images)
+        if images.ndim == 2:
+            images = images[None]
+        widths = np.maximum(np.broadcast_to(np.asarray(rectangle_widths), (images.shape[0],)), 1)
+        columns = np.arange(images.shape[-1])
+        keep = (columns >= widths[:, None]) & (columns < images.shape[-1] - widths[:, None])
+        return np.multiply(images, keep[:, None, :], out=out)
+
+    def generate_occluded_batches(self, images, targets, rng=None):
+        """ Yields (images, targets) batches of randomly occluded copies of the (N, H, W) image stack.
+        The batch buffer is allocated once and reused, so consume each batch before asking for the next
+        """
+        rng = rng or np.random.default_rng(self.random_state)
+        targets = np.asarray(targets, dtype=np.float64)
+        n = images.shape[0]
+        max_width = int(images.shape[-1] * self.max_occlusion_fraction)
+        buffer = np.empty((min(self.batch_size, n),) + images.shape[1:], dtype=images.dtype)
+        for _ in range(self.nr_augmentations):
+            order = rng.permutation(n)
+            for i in range(0, n, self.batch_size):
+                idx = order[i:i + self.batch_size]
+                batch = buffer[:len(idx)]
+                np.take(images, idx, axis=0, out=batch)
+                self.add_random_occlusion(batch, rng.integers(0, max_width + 1, len(idx)), out=batch)
+                yield batch, targets[idx]
+
+    @staticmethod
+    def get_contour_features(mask, pixel_spacing):
+        """ Returns the contour features (see FEATURE_NAMES) of the largest object in the uint8 mask """
+        import cv2
+        features = np.zeros(len(AbdominalCircumferenceEstimator.FEATURE_NAMES))
+        features[0] = 1.0
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if len(contours) == 0:
+            return features
+        contour = max(contours, key=cv2.contourArea)[:, 0, :]
+        scale = np.array([float(pixel_spacing[1]), float(pixel_spacing[0])])
+        points = contour * scale
+        lengths = np.linalg.norm(np.diff(points, axis=0, append=points[:1]), axis=1)
+        # Contour points on the image border or on a long straight vertical edge at the far left or
+        # right of the contour are considered clipped (by the FOV or an occlusion)
+        x = contour[:, 0]
+        h, w = mask.shape
+        clipped = (x == 0) | (x == w - 1) | (contour[:, 1] == 0) | (contour[:, 1] == h - 1)
+        for x_edge in (x.min(), x.max()):
+            on_edge = x == x_edge
+            if on_edge.sum() > 0.02 * len(x):
+                clipped |= on_edge
+        # A segment is clipped if both its end points are
+        clipped_segments = clipped & np.roll(clipped, -1)
+        features[1] = lengths.sum()
+        features[2] = lengths[~clipped_segments].sum()
+        features[4] = lengths[clipped_segments].sum()
+        features[5] = np.sqrt(cv2.contourArea(contour.astype(np.float32)) * scale[0] * scale[1])
+        visible_points = points[~clipped].astype(np.float32)
+        if len(visible_points) >= 5:
+            _, (a, b), _ = cv2.fitEllipse(visible_points)
+            a, b = a / 2.0, b / 2.0
+            # Ramanujan's approximation of the ellipse perimeter
+            features[3] = np.pi * (3 * (a + b) - np.sqrt((3 * a + b) * (a + 3 * b)))
+        else:
+            features[3] = features[1]
+        return features
+
+    @staticmethod
+    def get_mask(image):
+        return (image > 0).astype(np.uint8)
+
+    def get_features(self, images, pixel_spacings):
+        """ Returns an (N, F) feature matrix for an (N, H, W) stack of windowed images or masks """
+        return np.stack([
+            self.get_contour_features(self.get_mask(image), pixel_spacing) for image, pixel_spacing in zip(images, pixel_spacings)])
+
+    @staticmethod
+    def load_images(files):
+        """ Loads windowed images into one (N, H, W) float32 stack, zero-padded to the largest image """
+        images, pixel_spacings = [], []
+        for f in files:
+            p = pydicom.dcmread(f)
+            images.append(AbdominalCircumferenceCalculator.get_normalized_image(p))
+            pixel_spacings.append([float(x) for x in p.PixelSpacing])
+        h = max([image.shape[0] for image in images])
+        w = max([image.shape[1] for image in images])
+        stack = np.zeros((len(images), h, w), dtype=np.float32)
+        for i, image in enumerate(images):
+            stack[i, :image.shape[0], :image.shape[1]] = image
+        return stack, np.array(pixel_spacings)
+
+    def fit(self, features, targets):
+        n = features.shape[1]
+        penalty = self.ridge * np.eye(n)
+        penalty[0, 0] = 0.0
+        scale = np.abs(features).max(axis=0)
+        scale[scale == 0] = 1.0
+        x = features / scale
+        coefficients = np.linalg.solve(x.T @ x + penalty * len(x), x.T @ targets) / scale
+        return {'feature_names': list(AbdominalCircumferenceEstimator.FEATURE_NAMES), 'coefficients': coefficients.tolist()}
+
+    def predict(self, features):
+        if self.circumference_estimation_model is None:
+            # Without a trained model, fall back to geometric contour completion
+            return features[:, 3]
+        return features @ np.array(self.circumference_estimation_model['coefficients'])
+
+    @staticmethod
+    def get_errors(predictions, targets):
+        errors = predictions - np.asarray(targets, dtype=np.float64)
+        return {
+            'mae': float(np.abs(errors).mean()),
+            'rmse': float(np.sqrt((errors ** 2).mean())),
+            'max_abs_error': float(np.abs(errors).max()),
+        }
 
     def train(self):
-        """ Takes set of occluded L3 images with ground-truth circumferences (target labels) and trains
-        a model that can predict circumference from a new L3 image. The training process automatically 
-        splits the data into a training and test set.
+        """ Takes set of L3 images with ground-truth circumferences (target labels) and trains
+        a model that can predict circumference from a new, possibly occluded, L3 image. The training
+        process automatically splits the data into a training and test set.
         """
-        return []
+        if self.input_files is None or self.input_target_labels is None:
+            return None
+        rng = np.random.default_rng(self.random_state)
+        images, pixel_spacings = self.load_images(self.input_files)
+        targets = np.asarray(self.input_target_labels, dtype=np.float64)
+        order = rng.permutation(len(targets))
+        nr_test = int(round(len(targets) * self.test_fraction))
+        test_idx, train_idx = order[:nr_test], order[nr_test:]
+        features, feature_targets = [self.get_features(images[train_idx], pixel_spacings[train_idx])], [targets[train_idx]]
+        train_spacings = pixel_spacings[train_idx]
+        sample_idx = np.arange(len(train_idx))
+        # Targets are passed as indices so the pixel spacing of each occluded copy can be looked up
+        for batch, idx in self.generate_occluded_batches(images[train_idx], sample_idx, rng):
+            idx = idx.astype(int)
+            features.append(self.get_features(batch, train_spacings[idx]))
+            feature_targets.append(targets[train_idx][idx])
+        features, feature_targets = np.concatenate(features), np.concatenate(feature_targets)
+        self.circumference_estimation_model = self.fit(features, feature_targets)
+        self.circumference_estimation_model_params = {'train': self.get_errors(self.predict(features), feature_targets)}
+        if nr_test > 0:
+            test_features = self.get_features(images[test_idx], pixel_spacings[test_idx])
+            self.circumference_estimation_model_params['test'] = self.get_errors(self.predict(test_features), targets[test_idx])
+        return self.circumference_estimation_model
+
+    def save_model(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump({'model': self.circumference_estimation_model, 'params': self.circumference_estimation_model_params}, f, indent=4)
+
+    def load_model(self, file_path):
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+        self.circumference_estimation_model = data['model']
+        self.circumference_estimation_model_params = data.get('params')
+        return self.circumference_estimation_model
 
     def validate(self):
         """ Takes input files and target labels and validates the circumference estimation model."""
-        pass
+        if self.input_files is None or self.input_target_labels is None:
+            return None
+        images, pixel_spacings = self.load_images(self.input_files)
+        return self.get_errors(self.predict(self.get_features(images, pixel_spacings)), self.input_target_labels)
 
     def execute(self):
-        """ Does nothing for now but will be using the trained circumference estimation model to 
-        predict the abdominal circumference of the given input files. 
+        """ Uses the trained circumference estimation model (or ellipse completion if there is no
+        model) to predict the abdominal circumference of the given input files.
         """
-        pass
+        self.circumference_values = {}
+        if self.input_files is None:
+            return None
+        for i in range(0, len(self.input_files), self.batch_size):
+            files = self.input_files[i:i + self.batch_size]
+            images, pixel_spacings = self.load_images(files)
+            for f, value in zip(files, self.predict(self.get_features(images, pixel_spacings))):
+                self.circumference_values[f] = float(value)
+        return self.circumference_values
 
 
 if __name__ == '__main__':
-    from utils import apply_window
+    from calculator import BodyCompositionCalculator
+    from utils import apply_window, is_probability_file, load_probabilities, read_dicom_header
     calculator = AbdominalCircumferenceCalculator()
     calculator.input_files = ['/Users/Ralph/Desktop/nicole_squashed_output/HBP-MUMC-001-L3pre-no-phi.dcm']
     circumference_values = calculator.execute()
     import json
     print(json.dumps(circumference_values, indent=4))
-#     estimator = AbdominalCircumFerenceEstimator()
+#     estimator = AbdominalCircumferenceEstimator()
 #     estimator.input_files = []
 #     estimator.input_target_labels = []
 #     model = estimator.train()
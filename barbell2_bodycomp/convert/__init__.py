@@ -1,8 +1,27 @@
-from barbell2_bodycomp.convert.dcm2nifti import DicomToNifti
-from barbell2_bodycomp.convert.npy2nifti import NumpyToNifti
-from barbell2_bodycomp.convert.dcm2npy import Dicom2Numpy
-from barbell2_bodycomp.convert.npy2dcm import Numpy2Dicom
-from barbell2_bodycomp.convert.npy2nrrd import Numpy2Nrrd
-from barbell2_bodycomp.convert.npy2png import Numpy2Png
-from barbell2_bodycomp.convert.tag2dcm import Tag2Dicom
-from barbell2_bodycomp.convert.tag2npy import Tag2Numpy
+import importlib
+
+# Converters are imported on first access, see barbell2_bodycomp/__init__.py
+_lazy_imports = {
+    'DicomToNifti': 'barbell2_bodycomp.convert.dcm2nifti',
+    'NumpyToNifti': 'barbell2_bodycomp.convert.npy2nifti',
+    'Dicom2Numpy': 'barbell2_bodycomp.convert.dcm2npy',
+    'Numpy2Dicom': 'barbell2_bodycomp.convert.npy2dcm',
+    'Numpy2Nrrd': 'barbell2_bodycomp.convert.npy2nrrd',
+    'Numpy2Png': 'barbell2_bodycomp.convert.npy2png',
+    'Tag2Dicom': 'barbell2_bodycomp.convert.tag2dcm',
+    'Tag2Numpy': 'barbell2_bodycomp.convert.tag2npy',
+}
+
+__all__ = list(_lazy_imports.keys())
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -1,21 +1,33 @@
 import os
+import glob
+import shutil
 import logging
 import subprocess
+import concurrent.futures
+import numpy as np
+
+from barbell2_bodycomp.utils import read_dicom_header, write_nifti
 
 
 class DicomToNifti:
+    """ Converts a DICOM series to NIfTI, either with dcm2niix (default) or in-process with the
+    'python' engine. The Python engine sorts slices with the DICOM series index, decodes pixels on
+    a thread pool into one int16 volume of HU values and writes it with the given gzip compression
+    level (0 = stored, or use a .nii output file for no gzip at all).
+    """
+    DCM2NIIX = 'dcm2niix'
+    PYTHON = 'python'
+    GEOMETRY_TAGS = ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing']
 
     def __init__(self, logger=None):
-        try:
-            subprocess.call(['dcm2niix'])
-        except FileNotFoundError:
-            print(
-                'dcm2niix is not installed! Please install it using the following command:\n'
-                'curl -fLO https://github.com/rordenlab/dcm2niix/releases/latest/download/dcm2niix_mac.zip'
-            )
         self.input_directory = None
+        self.input_series_instance_uid = None   # (Optional) series to convert with the Python engine, default largest
         self.output_file = None
         self.overwrite = True
+        self.engine = DicomToNifti.DCM2NIIX
+        self.compression_level = 6
+        self.workers = 8
+        self.cache = None       # (Optional) ArtifactCache to reuse outputs for identical input series
         self.cmd = None
         if logger:
             self.logger = logger
@@ -26,6 +38,100 @@ class DicomToNifti:
     def exists(f):
         return os.path.isfile(f)
 
+    @staticmethod
+    def is_dcm2niix_installed():
+        return shutil.which('dcm2niix') is not None
+
+    @staticmethod
+    def get_affine(first_file, last_file, nr_slices):
+        """ Returns the RAS affine for a volume indexed (column, row, slice), with slices in the
+        order from first_file to last_file
+        """
+        first = read_dicom_header(first_file, DicomToNifti.GEOMETRY_TAGS)
+        last = read_dicom_header(last_file, DicomToNifti.GEOMETRY_TAGS)
+        orientation = np.array([float(x) for x in first.ImageOrientationPatient])
+        row_spacing, column_spacing = [float(x) for x in first.PixelSpacing]
+        origin = np.array([float(x) for x in first.ImagePositionPatient])
+        row_cosine, column_cosine = orientation[:3], orientation[3:]
+        if nr_slices > 1:
+            slice_step = (np.array([float(x) for x in last.ImagePositionPatient]) - origin) / (nr_slices - 1)
+        else:
+            slice_step = np.cross(row_cosine, column_cosine)
+        affine = np.eye(4)
+        affine[:3, 0] = row_cosine * column_spacing
+        affine[:3, 1] = column_cosine * row_spacing
+        affine[:3, 2] = slice_step
+        affine[:3, 3] = origin
+        # DICOM patient coordinates are LPS, NIfTI is RAS
+        return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+    @staticmethod
+    def read_slice(file_path, volume, k):
+        import pydicom
+        p = pydicom.dcmread(file_path)
+        slope, intercept = float(getattr(p, 'RescaleSlope', 1)), float(getattr(p, 'RescaleIntercept', 0))
+        pixels = p.pixel_array
+        if slope == 1 and intercept.is_integer():
+            np.add(pixels.T, np.int32(intercept), out=volume[:, :, k], casting='unsafe')
+        else:
+            volume[:, :, k] = np.rint(pixels.T * slope + intercept)
+
+    def read_volume(self, files):
+        first = read_dicom_header(files[0], ['Rows', 'Columns'])
+        volume = np.empty((int(first.Columns), int(first.Rows), len(files)), dtype=np.int16)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            # Consume results so exceptions in worker threads are raised here
+            list(executor.map(self.read_slice, files, [volume] * len(files), range(len(files))))
+        return volume
+
+    def write_volume(self, volume, affine, output_file):
+        import nibabel as nib
+        image = nib.Nifti1Image(volume, affine)
+        image.header.set_xyzt_units('mm', 'sec')
+        image.set_qform(affine, code=1)
+        image.set_sform(affine, code=1)
+        write_nifti(image, output_file, self.compression_level)
+
+    def execute_python(self):
+        from barbell2_bodycomp.dicomindex import DicomSeriesIndex
+        series = DicomSeriesIndex.get(self.input_directory, self.logger).get_series(self.input_series_instance_uid)
+        if series is None or len(series) == 0:
+            self.logger.error(f'No DICOM series found in {self.input_directory}')
+            return False
+        volume = self.read_volume(series.files)
+        affine = self.get_affine(series.files[0], series.files[-1], len(series))
+        self.write_volume(volume, affine, self.output_file)
+        return True
+
+    def execute_dcm2niix(self, output_file_name, output_file_dir, verbose=False):
+        if not self.is_dcm2niix_installed():
+            self.logger.error(
+                'dcm2niix is not installed! Please install it using the following command:\n'
+                'curl -fLO https://github.com/rordenlab/dcm2niix/releases/latest/download/dcm2niix_mac.zip'
+            )
+            return False
+        cmd = ['dcm2niix', '-m', 'y', '-z', 'y', '-f', output_file_name, '-o', output_file_dir, self.input_directory]
+        self.cmd = ' '.join(cmd)
+        if verbose:
+            self.logger.info(f'{self.cmd}')
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            self.logger.error(f'dcm2niix failed ({result.returncode}): {result.stdout.decode(errors="replace")}')
+            return False
+        return True
+
+    def get_cache_flags(self):
+        # The output format is part of the key so a .nii.gz entry is never placed at a .nii output file
+        gzipped = self.output_file.endswith('.gz')
+        if self.engine == DicomToNifti.PYTHON:
+            return {
+                'cmd': 'python',
+                'compression_level': self.compression_level,
+                'series': self.input_series_instance_uid,
+                'gzipped': gzipped,
+            }
+        return {'cmd': 'dcm2niix', 'flags': '-m y -z y', 'gzipped': gzipped, 'output_file_name': os.path.basename(self.output_file)}
+
     def execute(self, verbose=False):
         self.logger.info('Running DicomToNifti...')
         if self.input_directory is None:
@@ -34,13 +140,18 @@ class DicomToNifti:
         if self.output_file is None:
             self.logger.error('Output file not specified')
             return None
+        if self.engine not in [DicomToNifti.DCM2NIIX, DicomToNifti.PYTHON]:
+            self.logger.error(f'Unknown engine {self.engine}')
+            return None
         if not self.overwrite and self.exists(self.output_file):
             self.logger.info('Overwrite = False and output file already exists')
             return self.output_file
         if self.exists(self.output_file):
-            self.logger.warn('Output file already exists, deleting it')
+            self.logger.warning('Output file already exists, deleting it')
             file_base = os.path.splitext(self.output_file)[0]
-            os.system('rm {}*'.format(file_base))
+            for f in glob.glob(glob.escape(file_base) + '*'):
+                if os.path.isfile(f):
+                    os.remove(f)
         items = os.path.split(self.output_file)
         output_file_name = items[1]
         if output_file_name.endswith('.nii.gz'):
@@ -51,11 +162,23 @@ class DicomToNifti:
             self.logger.error('Output file must have extension .nii.gz or .nii')
             return None
         output_file_dir = items[0]
-        os.makedirs(output_file_dir, exist_ok=True)
-        self.cmd = f'dcm2niix -m y -z y -f {output_file_name} -o {output_file_dir} {self.input_directory}'
-        if verbose:
-            self.logger.info(f'{self.cmd}')
-        os.system(self.cmd)
+        if output_file_dir:
+            os.makedirs(output_file_dir, exist_ok=True)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.get_key([self.input_directory], self.get_cache_flags())
+            if self.cache.get(cache_key, self.output_file):
+                self.logger.info(f'Found output in cache ({cache_key})')
+                return self.output_file
+        if self.engine == DicomToNifti.PYTHON:
+            success = self.execute_python()
+        else:
+            success = self.execute_dcm2niix(output_file_name, output_file_dir or '.', verbose)
+        if not success or not self.exists(self.output_file):
+            self.logger.error(f'Conversion of {self.input_directory} to {self.output_file} failed')
+            return None
+        if cache_key is not None:
+            self.cache.put(cache_key, self.output_file)
         return self.output_file
 
 
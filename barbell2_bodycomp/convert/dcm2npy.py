@@ -1,7 +1,8 @@
 import pydicom
 import logging
+import numpy as np
 
-from barbell2_bodycomp.utils import apply_window
+from barbell2_bodycomp.utils import apply_window, rescale_pixels
 
 
 class Dicom2Numpy:
@@ -11,6 +12,7 @@ class Dicom2Numpy:
         self.npy_array = None
         self.window = None
         self.normalize_enabled = True
+        self.dtype = None   # Default int16 if rescale slope and intercept are integral, float32 otherwise
         if logger:
             self.logger = logger
         else:
@@ -26,7 +28,13 @@ class Dicom2Numpy:
     def is_normalize_enabled(self):
         return self.normalize_enabled
 
-    def execute(self):
+    def set_dtype(self, dtype):
+        self.dtype = dtype
+
+    def execute(self, out=None):
+        """ Returns the (windowed) pixels. If out is given, a (Rows, Columns) array, the result is
+        written into it. With a window out must be a float array
+        """
         self.npy_array = None
         if isinstance(self.dcm_file_path_or_obj, str):
             p = pydicom.dcmread(self.dcm_file_path_or_obj)
@@ -34,12 +42,22 @@ class Dicom2Numpy:
             p = self.dcm_file_path_or_obj
         pixels = p.pixel_array
         self.npy_array = pixels.reshape(p.Rows, p.Columns)
+        dtype = self.dtype
+        if dtype is None and self.window is not None:
+            # Windowed values are floats, so rescale directly to float32 and window in place
+            dtype = np.float32
         if self.is_normalize_enabled():
             b = p.RescaleIntercept
             m = p.RescaleSlope
-            self.npy_array = m * self.npy_array + b
+            self.npy_array = rescale_pixels(self.npy_array, m, b, dtype, out)
+        elif out is not None or self.window is not None:
+            if out is None:
+                out = np.empty(self.npy_array.shape, dtype=dtype)
+            np.copyto(out, self.npy_array, casting='unsafe')
+            self.npy_array = out
         if self.window is not None:
-            self.npy_array = apply_window(self.npy_array, self.window)
+            out = self.npy_array if self.npy_array.dtype.kind == 'f' else None
+            self.npy_array = apply_window(self.npy_array, self.window, out=out)
         return self.npy_array
 
 
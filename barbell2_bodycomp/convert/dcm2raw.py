@@ -1,9 +1,16 @@
 import os
+import time
+import shutil
+import tempfile
 import argparse
 import logging
+import collections
+import concurrent.futures
 import pydicom
 
-from barbell2_bodycomp.utils import is_dicom_file
+from pydicom.errors import InvalidDicomError
+
+from barbell2_bodycomp.utils import set_default_file_mode
 
 
 class DicomToRaw:
@@ -37,6 +44,94 @@ class DicomToRaw:
             return p
 
 
+def get_output_file_name(file_name):
+    if file_name.endswith('.dcm'):
+        return os.path.splitext(file_name)[0] + '_raw.dcm'
+    return file_name + '_raw.dcm'
+
+
+def convert_file(in_path, out_path, link=True, skip_existing=False):
+    """ Writes an uncompressed version of DICOM file in_path to out_path. Only files with a
+    compressed transfer syntax are decompressed, others are hardlinked (or copied if link=False
+    or hardlinks are not possible). Returns 'decompressed', 'linked', 'copied', 'skipped',
+    'not_dicom' or 'failed'
+    """
+    if skip_existing and os.path.exists(out_path):
+        return 'skipped'
+    try:
+        # Reads only the preamble and file meta, raises if the file is not DICOM
+        file_meta = pydicom.filereader.read_file_meta_info(in_path)
+    except (InvalidDicomError, OSError, EOFError):
+        return 'not_dicom'
+    tmp_file = None
+    try:
+        if link and not file_meta.TransferSyntaxUID.is_compressed:
+            if os.path.lexists(out_path):
+                os.remove(out_path)
+            try:
+                # Creating a hardlink is atomic, the output is either complete or absent
+                os.link(in_path, out_path)
+                return 'linked'
+            except OSError:
+                pass
+        # Write to a temporary file that is renamed into place, so an interrupted run never leaves
+        # a truncated output that --skip_existing would skip
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(out_path) or '.', suffix='.tmp')
+        os.close(fd)
+        if file_meta.TransferSyntaxUID.is_compressed:
+            d2r = DicomToRaw()
+            d2r.input_file_or_obj = in_path
+            d2r.output_file = tmp_file
+            d2r.save_to_file = True
+            d2r.execute()
+            status = 'decompressed'
+        else:
+            shutil.copyfile(in_path, tmp_file)
+            status = 'copied'
+        set_default_file_mode(tmp_file)
+        os.replace(tmp_file, out_path)
+        return status
+    except Exception as e:
+        logging.getLogger(__name__).error(f'Could not convert {in_path}: {e}')
+        return 'failed'
+    finally:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def convert_directory(in_dir, out_dir, workers=None, link=True, skip_existing=False, progress_interval=1000, logger=None):
+    """ Converts all DICOM files in in_dir using a process pool. At most workers * 4 files are
+    queued at a time so memory stays bounded for very large directories. Returns the number of
+    files per status (see convert_file)
+    """
+    logger = logger or logging.getLogger(__name__)
+    workers = workers or os.cpu_count() or 1
+    counts = collections.Counter()
+    start = time.perf_counter()
+
+    def update(future):
+        counts[future.result()] += 1
+        nr_done = sum(counts.values())
+        if nr_done % progress_interval == 0:
+            logger.info(f'{nr_done} files done ({nr_done / (time.perf_counter() - start):.0f} files/s): {dict(counts)}')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor, os.scandir(in_dir) as entries:
+        pending = set()
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith('._'):
+                continue
+            out_path = os.path.join(out_dir, get_output_file_name(entry.name))
+            pending.add(executor.submit(convert_file, entry.path, out_path, link, skip_existing))
+            if len(pending) >= workers * 4:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    update(future)
+        for future in concurrent.futures.as_completed(pending):
+            update(future)
+    logger.info(f'{sum(counts.values())} files done in {time.perf_counter() - start:.1f}s: {dict(counts)}')
+    return dict(counts)
+
+
 def main():
     # parse arguments
     parser = argparse.ArgumentParser()
@@ -44,27 +139,18 @@ def main():
     parser.add_argument('--out_dir', help='Output directory')
     parser.add_argument('--in_file', help='Input file name')
     parser.add_argument('--out_file', help='Output file name (overwrite otherwise)')
+    parser.add_argument('--workers', help='Number of processes for --in_dir (default: number of CPUs)', type=int)
+    parser.add_argument('--skip_existing', '--skip-existing', help='Skip files whose output already exists', action='store_true')
+    parser.add_argument(
+        '--no_link', '--no-link', help='Copy uncompressed files instead of hardlinking them to the input', action='store_true')
     args = parser.parse_args()
     # run it
     if args.in_dir is not None:
         if args.out_dir is not None:
             if args.in_dir != args.out_dir:
-                os.makedirs(args.out_dir, exist_ok=False)
-                for f in os.listdir(args.in_dir):
-                    f_path = os.path.join(args.in_dir, f)
-                    if is_dicom_file(f_path):
-                        out_filename = os.path.split(f_path)[1]  # gives me filename
-                        if out_filename.endswith('.dcm'):
-                            out_filename = os.path.splitext(out_filename)[0] + '_raw.dcm'
-                        else:
-                            out_filename = out_filename + '_raw.dcm'
-                        out_filepath = os.path.join(args.out_dir, out_filename)
-                        d2r = DicomToRaw()
-                        d2r.input_file_or_obj = f_path
-                        d2r.output_file = out_filepath
-                        d2r.save_to_file = True
-                        d2r.execute()
-                        print(f'saved to {out_filepath}')
+                os.makedirs(args.out_dir, exist_ok=args.skip_existing)
+                logging.basicConfig(level=logging.INFO)
+                convert_directory(args.in_dir, args.out_dir, args.workers, not args.no_link, args.skip_existing)
             else:
                 raise RuntimeError('in_dir cannot be equal to out_dir')
         else:
@@ -40,6 +40,6 @@ class Numpy2Dicom:
             p = self.dcm_file_path_or_obj
         if p.file_meta.TransferSyntaxUID.is_compressed:
             p.decompress()
-        p_new = create_fake_dicom(npy_array, p)
+        p_new = create_fake_dicom(npy_array, p, self.color_map)
         self.npy_dcm_file_path = os.path.join(self.output_dir, self.npy_dcm_file_name)
         p_new.save_as(self.npy_dcm_file_path)
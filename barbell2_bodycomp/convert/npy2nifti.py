@@ -1,40 +1,122 @@
 import os
+import re
 import argparse
 import logging
+import concurrent.futures
 import numpy as np
 import nibabel as nib
 
+from barbell2_bodycomp.segstore import SegmentationStore
+from barbell2_bodycomp.utils import write_nifti
+
 # logger = logging.getLogger(__name__)
 
 
-class NumpyToNifti:
+def natural_sort_key(f_path):
+    """ Sorts file names with numbers by their numeric value, e.g., slice2.npy before slice10.npy """
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', os.path.split(f_path)[1])]
+
+
+def regex_sort_key(pattern):
+    """ Returns a sort key that sorts files by the number captured by the first group of pattern """
+    regex = re.compile(pattern)
+
+    def sort_key(f_path):
+        match = regex.search(os.path.split(f_path)[1])
+        if match is None:
+            raise RuntimeError(f'File name {f_path} does not match sort key {pattern}')
+        return float(match.group(1))
+    return sort_key
 
+
+class NumpyToNifti:
+    """ Converts a 2D/3D NumPy array, a .npy file, a list of 2D .npy files or a SegmentationStore
+    (both stacked along the third axis in the order given by sort_key) to a NIfTI file
+    """
     def __init__(self, logger=None):
         self.input_file_or_array_obj = None
         self.flip_and_rotate = True
         self.output_file = None
         self.affine_transform = np.eye(4)
         self.version = 1
+        self.compression_level = 1  # gzip level for .nii.gz, 0 (fastest) to 9 (smallest)
+        self.sort_key = natural_sort_key
+        self.nifti_obj = None
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
 
+    @staticmethod
+    def transform(array):
+        """ Returns a view of array that is flipped along the first axis and then rotated by 90
+        degrees in the first two axes, same as np.rot90(np.flip(array, axis=0)), without copying
+        """
+        return np.swapaxes(array[::-1, ::-1], 0, 1)
+
+    def stack_arrays(self, keys, load):
+        """ Stacks the 2D arrays load(key) along the third axis in sort_key order of keys """
+        keys = sorted(keys, key=self.sort_key)
+        first = load(keys[0])
+        if first.ndim != 2:
+            raise RuntimeError(f'Only 2D arrays can be stacked, {keys[0]} has shape {first.shape}')
+        shape = self.transform(first).shape if self.flip_and_rotate else first.shape
+        volume = np.empty(shape + (len(keys),), dtype=first.dtype)
+        for k, key in enumerate(keys):
+            array = load(key)
+            if array.shape != first.shape:
+                raise RuntimeError(f'Shape of {key} {array.shape} does not match {first.shape}')
+            volume[:, :, k] = self.transform(array) if self.flip_and_rotate else array
+        return volume
+
+    def stack(self, f_paths):
+        return self.stack_arrays(f_paths, lambda f_path: np.load(f_path, mmap_mode='r'))
+
+    def stack_store(self, store):
+        return self.stack_arrays(store.names(), store.get_labels)
+
     def execute(self):
-        if isinstance(self.input_file_or_array_obj, str):
-            self.input_file_or_array_obj = np.load(self.input_file_or_array_obj)
-        if self.flip_and_rotate:
-            self.input_file_or_array_obj = np.flip(self.input_file_or_array_obj, axis=0)
-            self.input_file_or_array_obj = np.rot90(self.input_file_or_array_obj, k=1, axes=(0, 1))
+        # The input attribute is left untouched, transformed arrays are views written directly by nibabel
+        array = self.input_file_or_array_obj
+        if isinstance(array, (list, tuple)):
+            array = self.stack(array)
+        elif isinstance(array, SegmentationStore):
+            array = self.stack_store(array)
+        else:
+            if isinstance(array, str):
+                array = np.load(array, mmap_mode='r')
+            if self.flip_and_rotate:
+                array = self.transform(array)
         if self.version == 1:
-            self.nifti_obj = nib.Nifti1Image(self.input_file_or_array_obj, affine=self.affine_transform)
+            self.nifti_obj = nib.Nifti1Image(array, affine=self.affine_transform)
         elif self.version == 2:
-            self.nifti_obj = nib.Nifti2Image(self.input_file_or_array_obj, affine=self.affine_transform)
+            self.nifti_obj = nib.Nifti2Image(array, affine=self.affine_transform)
         else:
             raise RuntimeError(f'Unknown NIFTI version {self.version}')
-        nib.save(self.nifti_obj, self.output_file)
+        write_nifti(self.nifti_obj, self.output_file, self.compression_level)
         return self.output_file
-    
+
+
+def convert_file(f_path, out_filepath, version=1, flip_and_rotate=True, compression_level=1):
+    n2n = NumpyToNifti()
+    n2n.input_file_or_array_obj = f_path
+    n2n.output_file = out_filepath
+    n2n.version = version
+    n2n.flip_and_rotate = flip_and_rotate
+    n2n.compression_level = compression_level
+    return n2n.execute()
+
+
+def convert_directory(in_dir, out_dir, version=1, flip_and_rotate=True, compression_level=1, workers=None):
+    """ Converts each .npy file in in_dir to its own NIfTI file in out_dir using a process pool """
+    f_paths = sorted([os.path.join(in_dir, f) for f in os.listdir(in_dir) if f.endswith('.npy')])
+    out_filepaths = [os.path.join(out_dir, os.path.splitext(os.path.split(f)[1])[0] + '.nii.gz') for f in f_paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(convert_file, f_path, out_filepath, version, flip_and_rotate, compression_level)
+            for f_path, out_filepath in zip(f_paths, out_filepaths)]
+        return [future.result() for future in futures]
+
 
 def main():
     # parse arguments
@@ -45,24 +127,40 @@ def main():
     parser.add_argument('--out_file', help='Output file name (must be different)')
     parser.add_argument('--nifti_version', help='NIFTI version (default: 1)', default=1, type=int)
     parser.add_argument('--flip_rotate', help='Flip and rotate image (default: yes)', default='yes')
+    parser.add_argument('--compression_level', help='Gzip compression level 0-9 (default: 1)', default=1, type=int)
+    parser.add_argument('--workers', help='Number of processes for --in_dir (default: nr. of CPUs)', default=None, type=int)
+    parser.add_argument('--in_store', help='SegmentationStore directory to stack into one volume --out_file')
+    parser.add_argument('--stack', help='Stack the 2D .npy files in --in_dir into one volume --out_file', action='store_true')
+    parser.add_argument(
+        '--sort_key', help='Slice order for --stack: "name", "natural" (default) or a regular expression whose first '
+                           'group captures the slice number, e.g., "_(\\d+)\\.npy$"', default='natural')
     args = parser.parse_args()
-    if args.in_dir is not None:
+    flip_and_rotate = True if args.flip_rotate == 'yes' else False
+    if args.in_store is not None or (args.in_dir is not None and args.stack):
+        if args.out_file is None:
+            raise RuntimeError('out_file cannot be empty if stack or in_store is used')
+        n2n = NumpyToNifti()
+        if args.in_store is not None:
+            n2n.input_file_or_array_obj = SegmentationStore(args.in_store)
+        else:
+            n2n.input_file_or_array_obj = [
+                os.path.join(args.in_dir, f) for f in os.listdir(args.in_dir) if f.endswith('.npy')]
+        n2n.output_file = args.out_file
+        n2n.version = args.nifti_version
+        n2n.flip_and_rotate = flip_and_rotate
+        n2n.compression_level = args.compression_level
+        if args.sort_key == 'name':
+            n2n.sort_key = None
+        elif args.sort_key != 'natural':
+            n2n.sort_key = regex_sort_key(args.sort_key)
+        print(f'save to {n2n.execute()}')
+    elif args.in_dir is not None:
         if args.out_dir is not None:
             if args.in_dir != args.out_dir:
                 os.makedirs(args.out_dir, exist_ok=False)
-                for f in os.listdir(args.in_dir):
-                    if f.endswith('.npy'):
-                        f_path = os.path.join(args.in_dir, f)
-                        out_filename = os.path.split(f_path)[1]
-                        out_filename = os.path.splitext(out_filename)[0] + '.nii.gz'
-                        out_filepath = os.path.join(args.out_dir, out_filename)
-                        n2n = NumpyToNifti()
-                        n2n.input_file_or_array_obj = f_path
-                        n2n.output_file = out_filepath
-                        n2n.version = args.nifti_version
-                        n2n.flip_and_rotate = True if args.flip_rotate == 'yes' else False
-                        n2n.execute()
-                        print(f'save to {out_filepath}')
+                for out_filepath in convert_directory(
+                        args.in_dir, args.out_dir, args.nifti_version, flip_and_rotate, args.compression_level, args.workers):
+                    print(f'save to {out_filepath}')
             else:
                 raise RuntimeError('in_dir cannot be equal to out_dir')
         else:
@@ -70,13 +168,8 @@ def main():
     elif args.in_file is not None:
         if args.out_file is not None:
             if args.in_file.endswith('.npy') and args.in_file != args.out_file:
-                n2n = NumpyToNifti()
-                n2n.input_file_or_array_obj = args.in_file
-                n2n.output_file = args.out_file
-                n2n.version = args.nifti_version
-                n2n.flip_and_rotate = True if args.flip_rotate == 'yes' else False
-                n2n.execute()
-                print(f'save to {out_filepath}')
+                convert_file(args.in_file, args.out_file, args.nifti_version, flip_and_rotate, args.compression_level)
+                print(f'save to {args.out_file}')
             else:
                 raise RuntimeError('in_file cannot be equal to out_file')
         else:
@@ -1,9 +1,11 @@
 import os
+import argparse
+import concurrent.futures
 import numpy as np
 import logging
-import matplotlib.pyplot as plt
 
-from barbell2_bodycomp.utils import apply_color_map, get_alberta_color_map
+from barbell2_bodycomp.segstore import SegmentationStore
+from barbell2_bodycomp.utils import apply_color_map, apply_window, get_color_map, write_png
 
 
 class Numpy2Png:
@@ -16,6 +18,7 @@ class Numpy2Png:
         self.color_map = None
         self.output_dir = '..'
         self.window = [400, 50]
+        self.use_matplotlib = False     # Render through a matplotlib figure instead of writing the array directly
         if logger:
             self.logger = logger
         else:
@@ -31,19 +34,33 @@ class Numpy2Png:
         self.output_dir = output_dir
 
     def set_color_map(self, color_map):
-        if isinstance(color_map, str) and color_map == 'alberta':
-            self.color_map = get_alberta_color_map()
+        if isinstance(color_map, str):
+            self.color_map = get_color_map(color_map)
         else:
             self.color_map = color_map
 
     def set_window(self, window):
         self.window = window
 
-    def execute(self):
-        if isinstance(self.npy_array_or_file_path, str):
-            npy_array = np.load(self.npy_array_or_file_path)
+    def set_use_matplotlib(self, use_matplotlib):
+        self.use_matplotlib = use_matplotlib
+
+    def to_rgb_or_gray(self, npy_array):
+        """ Returns a uint8 RGB image if a color map is set, otherwise a windowed uint8 grayscale image """
+        if self.color_map is not None:
+            return apply_color_map(npy_array, self.color_map)
+        if self.window is not None:
+            gray = apply_window(npy_array.astype(np.float32), self.window)
         else:
-            npy_array = self.npy_array_or_file_path
+            gray = npy_array.astype(np.float32)
+            gray -= gray.min()
+            gray /= max(float(gray.max()), 1e-6)
+        gray *= 255.0
+        np.rint(gray, out=gray)
+        return gray.astype(np.uint8)
+
+    def execute_matplotlib(self, npy_array):
+        import matplotlib.pyplot as plt
         if self.color_map is not None:
             npy_array = apply_color_map(npy_array, self.color_map)
         fig = plt.figure(figsize=self.png_figure_size)
@@ -53,14 +70,97 @@ class Numpy2Png:
         else:
             plt.imshow(npy_array, cmap='gray')
         ax.axis('off')
-        self.png_file_path = os.path.join(self.output_dir, self.png_file_name)
         plt.savefig(self.png_file_path, bbox_inches='tight')
         plt.close('all')
 
+    def execute(self):
+        if isinstance(self.npy_array_or_file_path, str):
+            npy_array = np.load(self.npy_array_or_file_path)
+        else:
+            npy_array = self.npy_array_or_file_path
+        self.png_file_path = os.path.join(self.output_dir, self.png_file_name)
+        if self.use_matplotlib:
+            self.execute_matplotlib(npy_array)
+        else:
+            write_png(self.png_file_path, self.to_rgb_or_gray(npy_array))
+        return self.png_file_path
+
+
+def convert_file(f_path, output_dir, color_map, window):
+    n2p = Numpy2Png(f_path)
+    n2p.set_output_dir(output_dir)
+    n2p.set_png_file_name(os.path.splitext(os.path.split(f_path)[1])[0] + '.png')
+    if color_map is not None:
+        n2p.set_color_map(color_map)
+    n2p.set_window(window)
+    return n2p.execute()
+
+
+def convert_directory(input_dir, output_dir, color_map=None, window=(400, 50), workers=None):
+    """ Converts all .npy files in input_dir to PNG files in output_dir using a process pool """
+    os.makedirs(output_dir, exist_ok=True)
+    f_paths = sorted([os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.npy')])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_file, f_path, output_dir, color_map, window) for f_path in f_paths]
+        return [future.result() for future in futures]
+
+
+def convert_store_entry(store_dir, name, output_dir, color_map, window):
+    n2p = Numpy2Png(SegmentationStore.get(store_dir).get_labels(name))
+    n2p.set_output_dir(output_dir)
+    n2p.set_png_file_name(f'{name}.seg.png')
+    if color_map is not None:
+        n2p.set_color_map(color_map)
+    n2p.set_window(window)
+    return n2p.execute()
+
+
+def convert_store(store_dir, output_dir, color_map=None, window=(400, 50), workers=None):
+    """ Converts all label maps in a SegmentationStore to PNG files in output_dir using a process
+    pool. Each process reads the label maps from its own memory map of the store
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    names = SegmentationStore(store_dir).names()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_store_entry, store_dir, name, output_dir, color_map, window) for name in names]
+        return [future.result() for future in futures]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in_dir', help='Input directory')
+    parser.add_argument('--out_dir', help='Output directory')
+    parser.add_argument('--in_file', help='Input file name')
+    parser.add_argument('--out_file', help='Output file name')
+    parser.add_argument('--in_store', help='SegmentationStore directory (converts all its label maps to --out_dir)')
+    parser.add_argument('--color_map', help='Color map for label maps, e.g., alberta (default: none)', default=None)
+    parser.add_argument('--window', help='Window width and level for images (default: 400,50)', default='400,50')
+    parser.add_argument('--workers', help='Number of processes (default: nr. of CPUs)', default=None, type=int)
+    args = parser.parse_args()
+    window = [float(x) for x in args.window.split(',')]
+    if args.in_store is not None:
+        if args.out_dir is None:
+            raise RuntimeError('out_dir cannot be empty if in_store is not empty')
+        for f_path in convert_store(args.in_store, args.out_dir, args.color_map, window, args.workers):
+            print(f'saved to {f_path}')
+    elif args.in_dir is not None:
+        if args.out_dir is None:
+            raise RuntimeError('out_dir cannot be empty if in_dir is not empty')
+        for f_path in convert_directory(args.in_dir, args.out_dir, args.color_map, window, args.workers):
+            print(f'saved to {f_path}')
+    elif args.in_file is not None:
+        if args.out_file is None:
+            raise RuntimeError('out_file cannot be empty if in_file is not empty')
+        n2p = Numpy2Png(args.in_file)
+        n2p.set_output_dir(os.path.split(args.out_file)[0] or '.')
+        n2p.set_png_file_name(os.path.split(args.out_file)[1])
+        if args.color_map is not None:
+            n2p.set_color_map(args.color_map)
+        n2p.set_window(window)
+        print(f'saved to {n2p.execute()}')
+    else:
+        raise RuntimeError('no arguments provided')
+
 
 if __name__ == '__main__':
-    # pixels = np.load('/Users/Ralph/Desktop/output-segmentl3/1_pred.npy')
-    n2p = Numpy2Png('/Users/Ralph/Desktop/output-segmentl3/1_pred.npy')
-    n2p.set_color_map('alberta')
-    n2p.set_output_dir('/Users/Ralph/Desktop')
-    n2p.execute()
+    main()
@@ -1,21 +1,27 @@
+import os
 import logging
 
-from barbell2_bodycomp.utils import get_tag_pixels
+from barbell2_bodycomp.utils import get_tag_pixels, get_tag_pixels_for_directory
 
 
 class Tag2Numpy:
 
     def __init__(self, tag_file_path, shape=None, logger=None):
-        self.tag_file_path = tag_file_path
-        self.npy_array = None
-        self.shape = shape
+        self.tag_file_path = tag_file_path     # TAG file or directory containing TAG files
+        self.npy_array = None                  # Label map or, for a directory, dictionary of label maps
+        self.shape = shape                     # (Optional) overrides the shape found in the TAG header
+        self.mmap_mode = None
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
 
+    def set_mmap_mode(self, mmap_mode):
+        self.mmap_mode = mmap_mode
+
     def execute(self):
-        self.npy_array = get_tag_pixels(self.tag_file_path)
-        if self.shape is not None:
-            self.npy_array = self.npy_array.reshape(self.shape)
+        if os.path.isdir(self.tag_file_path):
+            self.npy_array = get_tag_pixels_for_directory(self.tag_file_path, self.shape, self.mmap_mode)
+        else:
+            self.npy_array = get_tag_pixels(self.tag_file_path, self.shape, self.mmap_mode)
         return self.npy_array
@@ -0,0 +1,173 @@
+import os
+import json
+import bisect
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+from barbell2_bodycomp.utils import scan_dicom_headers
+
+# Indexes built in this process, keyed by directory
+_indexes = {}
+
+
+class DicomSeries:
+
+    def __init__(self, series_instance_uid, records):
+        self.series_instance_uid = series_instance_uid
+        records = sorted(records, key=lambda r: (r['z'], r['file_name']))
+        self.z = [r['z'] for r in records]
+        self.files = [r['file_path'] for r in records]
+        self.instance_numbers = [r['instance_number'] for r in records]
+        self.sop_instance_uids = [r['sop_instance_uid'] for r in records]
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_nearest_idx(self, z):
+        i = bisect.bisect_left(self.z, z)
+        if i == 0:
+            return 0
+        if i == len(self.z):
+            return i - 1
+        return i - 1 if z - self.z[i - 1] <= self.z[i] - z else i
+
+    def get_nearest_z(self, z):
+        return self.z[self.get_nearest_idx(z)]
+
+    def get_files_between(self, z_min, z_max):
+        """ Returns files between the slices nearest to z_min and z_max (inclusive) in ascending z order """
+        if len(self.z) == 0:
+            return []
+        z_min_nearest = self.get_nearest_z(z_min)
+        z_max_nearest = self.get_nearest_z(z_max)
+        i = bisect.bisect_left(self.z, z_min_nearest)
+        j = bisect.bisect_right(self.z, z_max_nearest)
+        return self.files[i:j]
+
+    def get_file_at_instance_number(self, instance_number):
+        for i, n in enumerate(self.instance_numbers):
+            if n == instance_number:
+                return self.files[i]
+        return None
+
+
+class DicomSeriesIndex:
+    """ Index of DICOM header fields (z-position, InstanceNumber, SOPInstanceUID and SeriesInstanceUID)
+    for all files in a directory, grouped by series. The index is cached on disk and only files whose
+    size or modification time changed are read again.
+    """
+    CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'barbell2_bodycomp', 'index')
+    VERSION = 1
+
+    def __init__(self, directory, logger=None):
+        self.directory = directory
+        self.records = {}
+        self.series = {}
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def get(directory, logger=None):
+        """ Returns an up-to-date index for the given directory, reusing the one in memory or on disk """
+        index = _indexes.get(directory)
+        if index is None:
+            index = DicomSeriesIndex(directory, logger)
+            index.load()
+            _indexes[directory] = index
+        index.update()
+        return index
+
+    def get_cache_file(self):
+        h = hashlib.sha1(os.path.realpath(self.directory).encode('utf-8')).hexdigest()
+        return os.path.join(DicomSeriesIndex.CACHE_DIRECTORY, f'{h}.json')
+
+    def load(self):
+        try:
+            with open(self.get_cache_file(), 'r') as f:
+                data = json.load(f)
+            if data.get('version') == DicomSeriesIndex.VERSION and data.get('directory') == os.path.realpath(self.directory):
+                self.records = data['records']
+        except (OSError, ValueError, KeyError):
+            self.records = {}
+
+    def save(self):
+        os.makedirs(DicomSeriesIndex.CACHE_DIRECTORY, exist_ok=True)
+        cache_file = self.get_cache_file()
+        fd, tmp_file = tempfile.mkstemp(dir=DicomSeriesIndex.CACHE_DIRECTORY, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'version': DicomSeriesIndex.VERSION,
+                'directory': os.path.realpath(self.directory),
+                'records': self.records,
+            }, f)
+        os.replace(tmp_file, cache_file)
+
+    TAGS = ['ImagePositionPatient', 'InstanceNumber', 'SOPInstanceUID', 'SeriesInstanceUID']
+
+    @staticmethod
+    def read_records(file_paths, workers=16):
+        records = []
+        for header in scan_dicom_headers(file_paths, DicomSeriesIndex.TAGS, workers):
+            z = float(header['ImagePositionPatient'][2])
+            if not header['valid'] or np.isnan(z):
+                records.append({'z': None})
+                continue
+            instance_number = int(header['InstanceNumber'])
+            records.append({
+                'z': z,
+                'instance_number': instance_number if instance_number >= 0 else None,
+                'sop_instance_uid': str(header['SOPInstanceUID']),
+                'series_instance_uid': str(header['SeriesInstanceUID']),
+            })
+        return records
+
+    def update(self):
+        """ Re-reads files that are new or changed since the index was built, drops files that
+        no longer exist and saves the index if anything changed
+        """
+        records = {}
+        changed_files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('._'):
+                    continue
+                stat = entry.stat()
+                record = self.records.get(entry.name)
+                if record is None or record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+                    changed_files[entry.name] = (entry.path, stat)
+                else:
+                    records[entry.name] = record
+        if len(changed_files) > 0:
+            new_records = self.read_records([file_path for file_path, _ in changed_files.values()])
+            for (file_name, (_, stat)), record in zip(changed_files.items(), new_records):
+                record.update({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+                records[file_name] = record
+        changed = len(changed_files) > 0 or len(records) != len(self.records)
+        self.records = records
+        if changed or not self.series:
+            self.build_series()
+        if changed:
+            self.save()
+
+    def build_series(self):
+        grouped = {}
+        for file_name, record in self.records.items():
+            if record['z'] is None:
+                continue
+            grouped.setdefault(record['series_instance_uid'], []).append(
+                dict(record, file_name=file_name, file_path=os.path.join(self.directory, file_name)))
+        self.series = {uid: DicomSeries(uid, records) for uid, records in grouped.items()}
+        if len(self.series) > 1:
+            self.logger.warning(f'Directory {self.directory} contains {len(self.series)} series')
+
+    def get_series(self, series_instance_uid=None):
+        """ Returns the given series or, if not specified, the series with the most files """
+        if series_instance_uid is not None:
+            return self.series.get(series_instance_uid)
+        if len(self.series) == 0:
+            return None
+        return max(self.series.values(), key=lambda series: (len(series), series.series_instance_uid))
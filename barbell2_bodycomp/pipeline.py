@@ -0,0 +1,242 @@
+import os
+import json
+import pickle
+import hashlib
+import logging
+import tempfile
+import pydicom
+
+from barbell2_bodycomp.calculator import BodyCompositionCalculator
+from barbell2_bodycomp.convert.dcm2nifti import DicomToNifti
+from barbell2_bodycomp.convert.dcm2raw import DicomToRaw
+from barbell2_bodycomp.seg import MuscleFatSegmentator
+from barbell2_bodycomp.selectroi import RoiSelector
+from barbell2_bodycomp.selectslice import SliceSelector
+from barbell2_bodycomp.totalseg import TotalSegmentator
+from barbell2_bodycomp.utils import get_pixels
+
+
+class PipelineStage:
+
+    def __init__(self, name, function, inputs=None, params=None):
+        self.name = name
+        self.function = function        # Called with the results of the input stages and the stage's cache key
+        self.inputs = inputs or []      # Names of stages this stage depends on
+        self.params = params or {}      # JSON-serializable parameters that determine the stage's output
+
+
+class L3Pipeline:
+    """ Runs DicomToNifti, TotalSegmentator, RoiSelector, SliceSelector, MuscleFatSegmentator and
+    BodyCompositionCalculator as a DAG of stages. Stages hand off arrays and file paths in memory
+    and only stages listed in checkpoints are written to disk. Each stage result is cached under a
+    key derived from its parameters and the keys of its inputs, so a rerun resumes from the first
+    stage whose inputs or parameters changed.
+    """
+    DICOM2NIFTI = 'dicom2nifti'
+    TOTALSEG = 'totalseg'
+    ROI = 'roi'
+    SLICES = 'slices'
+    SEGMENTATION = 'segmentation'
+    METRICS = 'metrics'
+
+    def __init__(self, logger=None):
+        self.input_dicom_directory = None
+        self.output_directory = None
+        self.model_files = None
+        self.roi = RoiSelector.VERTEBRAE_L3
+        self.slice_selection_mode = SliceSelector.MEDIAN
+        self.fast = False
+        self.dicom2nifti_engine = DicomToNifti.DCM2NIIX
+        self.batch_size = 1
+        self.artifact_cache = None      # (Optional) ArtifactCache for dcm2niix and TotalSegmentator outputs
+        self.checkpoints = [L3Pipeline.DICOM2NIFTI, L3Pipeline.TOTALSEG, L3Pipeline.SLICES, L3Pipeline.METRICS]
+        self.cache = {}                 # In-memory stage results, keyed by stage key
+        self.stage_keys = None          # Stage keys of the last run
+        self.stage_results = None       # Results of the stages needed in the last run
+        self.output_metrics = None
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def get_directory_fingerprint(directory):
+        items = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    items.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        return hashlib.sha256(json.dumps(sorted(items)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_stage_key(stage, input_keys):
+        data = json.dumps({'stage': stage.name, 'params': stage.params, 'inputs': input_keys}, sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+    def get_stage_directory(self, stage_name, key):
+        return os.path.join(self.output_directory, stage_name, key)
+
+    def get_checkpoint_file(self, stage_name, key):
+        return os.path.join(self.output_directory, 'checkpoints', f'{stage_name}-{key}.pkl')
+
+    def load_checkpoint(self, stage_name, key):
+        try:
+            with open(self.get_checkpoint_file(stage_name, key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save_checkpoint(self, stage_name, key, result):
+        checkpoint_file = self.get_checkpoint_file(stage_name, key)
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(checkpoint_file), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, checkpoint_file)
+
+    def get_stages(self):
+        """ Returns the pipeline stages in topological order """
+        dicom_fingerprint = self.get_directory_fingerprint(self.input_dicom_directory)
+        model_hashes = sorted([
+            MuscleFatSegmentator.get_file_hash(f) for f in self.model_files]) if self.model_files else []
+        return [
+            PipelineStage(L3Pipeline.DICOM2NIFTI, self.run_dicom2nifti, params={
+                'dicom': dicom_fingerprint, 'engine': self.dicom2nifti_engine}),
+            PipelineStage(L3Pipeline.TOTALSEG, self.run_totalseg, [L3Pipeline.DICOM2NIFTI], {'fast': self.fast}),
+            PipelineStage(L3Pipeline.ROI, self.run_roi, [L3Pipeline.TOTALSEG], {'roi': self.roi}),
+            PipelineStage(L3Pipeline.SLICES, self.run_slices, [L3Pipeline.ROI, L3Pipeline.DICOM2NIFTI], {
+                'mode': self.slice_selection_mode, 'dicom': dicom_fingerprint}),
+            PipelineStage(L3Pipeline.SEGMENTATION, self.run_segmentation, [L3Pipeline.SLICES], {'models': model_hashes}),
+            PipelineStage(L3Pipeline.METRICS, self.run_metrics, [L3Pipeline.SEGMENTATION]),
+        ]
+
+    def run_dicom2nifti(self, key):
+        output_file = os.path.join(self.get_stage_directory(L3Pipeline.DICOM2NIFTI, key), 'volume.nii.gz')
+        dicom2nifti = DicomToNifti(logger=self.logger)
+        dicom2nifti.input_directory = self.input_dicom_directory
+        dicom2nifti.output_file = output_file
+        dicom2nifti.overwrite = False
+        dicom2nifti.engine = self.dicom2nifti_engine
+        dicom2nifti.cache = self.artifact_cache
+        return dicom2nifti.execute()
+
+    def run_totalseg(self, volume_file, key):
+        output_directory = self.get_stage_directory(L3Pipeline.TOTALSEG, key)
+        os.makedirs(output_directory, exist_ok=True)
+        totalseg = TotalSegmentator(logger=self.logger)
+        totalseg.input_file = volume_file
+        totalseg.output_directory = output_directory
+        totalseg.fast = self.fast
+        totalseg.overwrite = False
+        totalseg.cache = self.artifact_cache
+        return totalseg.execute()
+
+    def run_roi(self, totalseg_directory, key):
+        # No need to copy the ROI file like RoiSelector does, just pass on its path
+        roi_file = os.path.join(totalseg_directory, self.roi)
+        if not os.path.isfile(roi_file):
+            self.logger.error(f'ROI file {roi_file} does not exist')
+            return None
+        return roi_file
+
+    def run_slices(self, roi_file, volume_file, key):
+        selector = SliceSelector(logger=self.logger)
+        selector.input_roi = roi_file
+        selector.input_volume = volume_file
+        selector.input_dicom_directory = self.input_dicom_directory
+        selector.mode = self.slice_selection_mode
+        return selector.execute()
+
+    @staticmethod
+    def load_dicom(f_path):
+        d2r = DicomToRaw()
+        d2r.input_file_or_obj = pydicom.dcmread(f_path)
+        p = d2r.execute()
+        return get_pixels(p, normalize=True), [float(x) for x in p.PixelSpacing]
+
+    def run_segmentation(self, files, key):
+        """ Segments the selected slices in memory. Returns a dictionary of file path to HU image,
+        pixel spacing and label map
+        """
+        segmentator = MuscleFatSegmentator(logger=self.logger)
+        segmentator.model_files = self.model_files
+        model, contour_model, params = segmentator.load_model_files()
+        results = {}
+        for f in files:
+            image, pixel_spacing = self.load_dicom(f)
+            results[f] = {'image': image, 'pixel_spacing': pixel_spacing}
+        items = [(f, results[f]['image']) for f in files]
+        for batch in segmentator.iterate_batches(items, self.batch_size):
+            pred = segmentator.predict_batch(model, contour_model, [image for _, image in batch], params)
+            for j, (f, _) in enumerate(batch):
+                results[f]['labels'] = segmentator.get_label_map(pred[j])
+        return results
+
+    def run_metrics(self, segmentations, key):
+        output_metrics = {}
+        for f, segmentation in segmentations.items():
+            output_metrics[f] = BodyCompositionCalculator.calculate_metrics(
+                segmentation['image'], segmentation['labels'], segmentation['pixel_spacing'])
+        return output_metrics
+
+    def execute(self):
+        self.logger.info('Running L3Pipeline...')
+        if self.input_dicom_directory is None:
+            self.logger.error('Input DICOM directory not specified')
+            return None
+        if self.output_directory is None:
+            self.logger.error('Output directory not specified')
+            return None
+        if self.model_files is None:
+            self.logger.error('Model files not specified')
+            return None
+        os.makedirs(self.output_directory, exist_ok=True)
+        stages = {}
+        self.stage_keys, self.stage_results = {}, {}
+        for stage in self.get_stages():
+            stages[stage.name] = stage
+            self.stage_keys[stage.name] = self.get_stage_key(stage, [self.stage_keys[name] for name in stage.inputs])
+        self.output_metrics = self.resolve(stages, L3Pipeline.METRICS)
+        return self.output_metrics
+
+    def resolve(self, stages, stage_name):
+        """ Returns the result of the given stage from the in-memory cache or a checkpoint, or runs
+        it after resolving its inputs. Stages whose results are not needed are never run
+        """
+        if stage_name in self.stage_results:
+            return self.stage_results[stage_name]
+        stage = stages[stage_name]
+        key = self.stage_keys[stage_name]
+        if key in self.cache:
+            self.logger.info(f'{stage_name}: using in-memory result ({key})')
+            result = self.cache[key]
+        else:
+            result = self.load_checkpoint(stage_name, key) if stage_name in self.checkpoints else None
+            if result is not None:
+                self.logger.info(f'{stage_name}: using checkpoint ({key})')
+            else:
+                inputs = [self.resolve(stages, name) for name in stage.inputs]
+                if any(x is None for x in inputs):
+                    return None
+                self.logger.info(f'{stage_name}: running ({key})')
+                result = stage.function(*inputs, key)
+                if result is None:
+                    self.logger.error(f'Stage {stage_name} failed')
+                    return None
+                if stage_name in self.checkpoints:
+                    self.save_checkpoint(stage_name, key, result)
+            self.cache[key] = result
+        self.stage_results[stage_name] = result
+        return result
+
+    def as_df(self):
+        import pandas as pd
+        if self.output_metrics is None:
+            return None
+        data = {'file': []}
+        for k in self.output_metrics.keys():
+            data['file'].append(k)
+            for metric, value in self.output_metrics[k].items():
+                data.setdefault(metric, []).append(value)
+        return pd.DataFrame(data=data)
@@ -1,12 +1,23 @@
 import os
 import json
+import shutil
+import hashlib
 import zipfile
 import logging
+import tempfile
+import threading
 import pydicom
 import numpy as np
 
 from barbell2_bodycomp.convert import dcm2raw
-from barbell2_bodycomp.utils import is_dicom_file, get_pixels
+from barbell2_bodycomp.segstore import SegmentationStore
+from barbell2_bodycomp.utils import is_dicom_file, get_pixels, remap_labels, save_probabilities
+
+# Models loaded in this process, keyed by the SHA-256 of their ZIP file, so repeated execute()
+# calls and multiple segmentator instances share them
+_loaded_models = {}
+_loaded_models_lock = threading.Lock()
+_file_hashes = {}
 
 
 class MuscleFatSegmentator:
@@ -19,21 +30,71 @@ class MuscleFatSegmentator:
         # self.image_dimensions = None
         self.model_files = None
         self.mode = MuscleFatSegmentator.ARGMAX
+        self.batch_size = 1
+        self.probabilities_encoding = None      # None (float32), 'float16' or 'uint8', see utils.save_probabilities
+        self.probabilities_compressed = False
+        self.output_store = False               # Append label maps to a SegmentationStore in output_directory (ARGMAX mode)
         self.output_directory = None
-        self.output_segmentation_files = None
+        self.output_segmentation_files = None   # Segmentation files or, with output_store, names in the store
+        self.output_segmentation_store = None
+        self.buffers = {}                       # Preallocated buffers of normalize_batch()
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
 
+    MODEL_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'barbell2_bodycomp', 'models')
+
+    @staticmethod
+    def get_file_hash(file_path):
+        stat = os.stat(file_path)
+        key = (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+        if key not in _file_hashes:
+            h = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            _file_hashes[key] = h.hexdigest()
+        return _file_hashes[key]
+
+    @staticmethod
+    def extract_model(file_path, file_hash):
+        """ Extracts the model ZIP file into its own cache directory named after the ZIP file's hash.
+        Extraction happens in a temporary directory that is renamed into place, so concurrent
+        processes never see a partially extracted model
+        """
+        model_directory = os.path.join(MuscleFatSegmentator.MODEL_CACHE_DIRECTORY, file_hash)
+        if os.path.isdir(model_directory):
+            return model_directory
+        os.makedirs(MuscleFatSegmentator.MODEL_CACHE_DIRECTORY, exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(prefix=f'.{file_hash}.', dir=MuscleFatSegmentator.MODEL_CACHE_DIRECTORY)
+        try:
+            with zipfile.ZipFile(file_path) as zip_obj:
+                zip_obj.extractall(path=tmp_directory)
+            os.rename(tmp_directory, model_directory)
+        except OSError:
+            # Another process finished extracting the same model first
+            if not os.path.isdir(model_directory):
+                raise
+        finally:
+            if os.path.isdir(tmp_directory):
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+        return model_directory
+
     @staticmethod
     def load_model(file_path):
-        import tensorflow as tf
-        model_directory = '/tmp/barbell2_bodycomp/model'
-        os.makedirs(model_directory, exist_ok=True)
-        with zipfile.ZipFile(file_path) as zip_obj:
-            zip_obj.extractall(path=model_directory)
-        return tf.keras.models.load_model(model_directory, compile=False)
+        file_hash = MuscleFatSegmentator.get_file_hash(file_path)
+        with _loaded_models_lock:
+            if file_hash not in _loaded_models:
+                import tensorflow as tf
+                model_directory = MuscleFatSegmentator.extract_model(file_path, file_hash)
+                _loaded_models[file_hash] = tf.keras.models.load_model(model_directory, compile=False)
+            return _loaded_models[file_hash]
+
+    @staticmethod
+    def clear_loaded_models():
+        with _loaded_models_lock:
+            _loaded_models.clear()
 
     @staticmethod
     def load_params(file_path):
@@ -64,9 +125,48 @@ class MuscleFatSegmentator:
         img = np.divide(c, d, np.zeros_like(c), where=d != 0)
         return img
 
+    def get_buffer(self, name, shape, dtype):
+        """ Returns a preallocated buffer for name, reallocated only if shape or dtype change """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    def normalize_batch(self, images, min_bound, max_bound, out=None):
+        """ Same as normalize() for each image of an (N, H, W) stack or list of equally sized images,
+        written to out (default: a float32 buffer of shape (N, H, W)). Intermediate results use
+        the same dtype as normalize() so values are identical, in preallocated buffers that are
+        reused between calls
+        """
+        n, shape = len(images), (len(images), *images[0].shape)
+        # Result dtype of normalize(), e.g., float64 for int16 images and float32 for float32 images
+        dtype = ((images[0].flat[:1] - min_bound) / (max_bound - min_bound)).dtype
+        work = self.get_buffer('work', shape, dtype)
+        mask = self.get_buffer('mask', shape, bool)
+        mask2 = self.get_buffer('mask2', shape, bool)
+        if out is None:
+            out = self.get_buffer('out', shape, np.float32)
+        if isinstance(images, np.ndarray):
+            np.subtract(images, min_bound, out=work, casting='unsafe')
+        else:
+            for i in range(n):
+                np.subtract(images[i], min_bound, out=work[i], casting='unsafe')
+        np.divide(work, max_bound - min_bound, out=work)
+        np.greater(work, 1, out=mask)
+        np.logical_or(mask, np.less(work, 0, out=mask2), out=mask)
+        np.copyto(work, 0, where=mask)
+        lo = work.min(axis=(1, 2), keepdims=True)
+        hi = work.max(axis=(1, 2), keepdims=True)
+        d = hi - lo
+        np.subtract(work, lo, out=work)
+        out[...] = 0
+        np.divide(work, d, out=out, where=np.broadcast_to(d != 0, shape), casting='same_kind')
+        return out
+
     def predict_contour(self, contour_model, src_img, params):
-        ct = np.copy(src_img)
-        ct = self.normalize(ct, params['min_bound_contour'], params['max_bound_contour'])
+        # normalize() does not modify its input so no copy is needed
+        ct = self.normalize(src_img, params['min_bound_contour'], params['max_bound_contour'])
         img2 = np.expand_dims(ct, 0)
         img2 = np.expand_dims(img2, -1)
         pred = contour_model.predict([img2])
@@ -75,13 +175,91 @@ class MuscleFatSegmentator:
         mask = np.uint8(pred_max)
         return mask
 
+    def predict_contour_batch(self, contour_model, images, params):
+        batch = np.empty((len(images), *images[0].shape, 1), dtype=np.float32)
+        self.normalize_batch(images, params['min_bound_contour'], params['max_bound_contour'], out=batch[..., 0])
+        pred = contour_model.predict([batch], batch_size=len(images))
+        return np.uint8(pred.argmax(axis=-1))
+
+    def predict_batch(self, model, contour_model, images, params):
+        """ Runs the contour model (if any) and the muscle/fat model on a list of equally sized
+        HU images in one predict() call each. Returns predictions of shape (N, H, W, C)
+        """
+        masks = None
+        if contour_model is not None:
+            masks = self.predict_contour_batch(contour_model, images, params)
+        batch = np.empty((len(images), *images[0].shape, 1), dtype=np.float32)
+        self.normalize_batch(images, params['min_bound'], params['max_bound'], out=batch[..., 0])
+        if masks is not None:
+            # Masks are 0 or 1 so multiplying in float32 gives the same result as in float64
+            np.multiply(batch[..., 0], masks, out=batch[..., 0])
+        return model.predict([batch], batch_size=len(images))
+
+    @staticmethod
+    def load_image(f):
+        p = pydicom.dcmread(f)
+        # if dicom file compressed, decompress it before continuing
+        d2r = dcm2raw.DicomToRaw()
+        d2r.input_file_or_obj = p
+        d2r.save_to_file = False
+        p = d2r.execute()
+        return get_pixels(p, normalize=True)
+
     @staticmethod
     def convert_labels_to_157(prediction):
-        new_prediction = np.copy(prediction)
-        new_prediction[new_prediction == 1] = 1
-        new_prediction[new_prediction == 2] = 5
-        new_prediction[new_prediction == 3] = 7
-        return new_prediction
+        return remap_labels(prediction, {1: 1, 2: 5, 3: 7})
+
+    def get_label_map(self, pred):
+        pred_max = np.squeeze(pred).argmax(axis=-1)
+        return self.convert_labels_to_157(pred_max)
+
+    def save_prediction(self, f_name, pred, source=None):
+        pred_squeeze = np.squeeze(pred)
+        if self.mode == MuscleFatSegmentator.ARGMAX and self.output_segmentation_store is not None:
+            self.output_segmentation_store.append(f_name, self.get_label_map(pred), source)
+            self.output_segmentation_files.append(f_name)
+        elif self.mode == MuscleFatSegmentator.ARGMAX:
+            pred_max = self.get_label_map(pred)
+            segmentation_file = os.path.join(self.output_directory, f'{f_name}.seg.npy')
+            self.output_segmentation_files.append(segmentation_file)
+            np.save(segmentation_file, pred_max)
+        elif self.mode == MuscleFatSegmentator.PROBABILITIES:
+            segmentation_file = save_probabilities(
+                os.path.join(self.output_directory, f'{f_name}.seg.prob.npy'),
+                pred_squeeze,
+                self.probabilities_encoding,
+                self.probabilities_compressed,
+            )
+            self.output_segmentation_files.append(segmentation_file)
+        else:
+            self.logger.warning(f'Unknown mode {self.mode}')
+
+    @staticmethod
+    def iterate_batches(items, batch_size):
+        """ Yields lists of at most batch_size (key, image) items in input order. Batches only contain
+        images of the same shape so they can be stacked
+        """
+        batch_size = max(1, batch_size or 1)
+        batch = []
+        for key, image in items:
+            if len(batch) == batch_size or (len(batch) > 0 and image.shape != batch[0][1].shape):
+                yield batch
+                batch = []
+            batch.append((key, image))
+        if len(batch) > 0:
+            yield batch
+
+    def iterate_images(self):
+        for f in self.input_files:
+            if not is_dicom_file(f):
+                self.logger.warning(f'File {f} is not a valid DICOM file')
+                continue
+            yield f, self.load_image(f)
+
+    def process_batch(self, model, contour_model, params, file_names, images, sources=None):
+        pred = self.predict_batch(model, contour_model, images, params)
+        for i, f_name in enumerate(file_names):
+            self.save_prediction(f_name, pred[i], sources[i] if sources else None)
 
     def execute(self):
         self.logger.info('Running MuscleFatSegmentator...')
@@ -100,42 +278,20 @@ class MuscleFatSegmentator:
         os.makedirs(self.output_directory, exist_ok=True)
         model, contour_model, params = self.load_model_files()
         self.output_segmentation_files = []
-        for f in self.input_files:
-            f_name = os.path.split(f)[1]
-            if is_dicom_file(f):
-                p = pydicom.dcmread(f)
-                # if dicom file compressed, decompress it before continuing
-                d2r = dcm2raw.DicomToRaw()
-                d2r.input_file_or_obj = p
-                d2r.save_to_file = False
-                p = d2r.execute()
-                # continue processing
-                img1 = get_pixels(p, normalize=True)
-                if contour_model is not None:
-                    mask = self.predict_contour(contour_model, img1, params)
-                    img1 = self.normalize(img1, params['min_bound'], params['max_bound'])
-                    img1 = img1 * mask
-                else:
-                    img1 = self.normalize(img1, params['min_bound'], params['max_bound'])
-                img1 = img1.astype(np.float32)
-                img2 = np.expand_dims(img1, 0)
-                img2 = np.expand_dims(img2, -1)
-                pred = model.predict([img2])
-                pred_squeeze = np.squeeze(pred)
-                if self.mode == MuscleFatSegmentator.ARGMAX:
-                    pred_max = pred_squeeze.argmax(axis=-1)
-                    pred_max = self.convert_labels_to_157(pred_max)
-                    segmentation_file = os.path.join(self.output_directory, f'{f_name}.seg.npy')
-                    self.output_segmentation_files.append(segmentation_file)
-                    np.save(segmentation_file, pred_max)
-                elif self.mode == MuscleFatSegmentator.PROBABILITIES:
-                    segmentation_file = os.path.join(self.output_directory, f'{f_name}.seg.prob.npy')
-                    self.output_segmentation_files.append(segmentation_file)
-                    np.save(segmentation_file, pred_squeeze)
-                else:
-                    self.logger.warn(f'Unknown mode {self.mode}')
+        self.output_segmentation_store = None
+        if self.output_store:
+            if self.mode == MuscleFatSegmentator.ARGMAX:
+                self.output_segmentation_store = SegmentationStore(self.output_directory, self.logger)
             else:
-                self.logger.warning(f'File {f} is not a valid DICOM file')
+                self.logger.warning('Segmentation store only holds label maps, writing probabilities to separate files')
+        try:
+            for batch in self.iterate_batches(self.iterate_images(), self.batch_size):
+                files = [f for f, _ in batch]
+                self.process_batch(
+                    model, contour_model, params, [os.path.split(f)[1] for f in files], [image for _, image in batch], files)
+        finally:
+            if self.output_segmentation_store is not None:
+                self.output_segmentation_store.close()
         return self.output_segmentation_files
 
 
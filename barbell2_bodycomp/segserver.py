@@ -0,0 +1,207 @@
+import json
+import time
+import queue
+import argparse
+import logging
+import threading
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from barbell2_bodycomp.seg import MuscleFatSegmentator
+
+
+class SegmentationJob:
+
+    def __init__(self, input_files, output_directory, mode, batch_size):
+        self.input_files = input_files
+        self.output_directory = output_directory
+        self.mode = mode
+        self.batch_size = batch_size
+        self.output_segmentation_files = None
+        self.error = None
+        self.received = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def timings(self):
+        return {
+            'queued_secs': self.started - self.received,
+            'segmentation_secs': self.finished - self.started,
+            'total_secs': self.finished - self.received,
+        }
+
+
+class MuscleFatSegmentatorServer:
+    """ Keeps the MuscleFatSegmentator models in memory and segments DICOM files on request. Requests
+    are accepted on a localhost HTTP port (POST /segment with a JSON body) and processed one at
+    a time from a queue by a single worker thread.
+    """
+    def __init__(self, model_files, host='127.0.0.1', port=8765, logger=None):
+        self.model_files = model_files
+        self.host = host
+        self.port = port
+        self.jobs = queue.Queue()
+        self.http_server = None
+        self.worker = None
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+    def load_models(self):
+        segmentator = MuscleFatSegmentator(logger=self.logger)
+        segmentator.model_files = self.model_files
+        segmentator.load_model_files()
+
+    def submit(self, input_files, output_directory, mode=MuscleFatSegmentator.ARGMAX, batch_size=1):
+        job = SegmentationJob(input_files, output_directory, mode, batch_size)
+        self.jobs.put(job)
+        return job
+
+    def process_job(self, job):
+        segmentator = MuscleFatSegmentator(logger=self.logger)
+        segmentator.input_files = job.input_files
+        segmentator.output_directory = job.output_directory
+        segmentator.model_files = self.model_files
+        segmentator.mode = job.mode
+        segmentator.batch_size = job.batch_size
+        job.output_segmentation_files = segmentator.execute()
+        if job.output_segmentation_files is None:
+            job.error = 'Segmentation failed, check input files and output directory'
+
+    def run_worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job.started = time.perf_counter()
+            try:
+                self.process_job(job)
+            except Exception as e:
+                self.logger.exception('Segmentation job failed')
+                job.error = str(e)
+            job.finished = time.perf_counter()
+            job.done.set()
+
+    def create_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/status':
+                    self.send_json(200, {'status': 'ok', 'queued_jobs': server.jobs.qsize()})
+                else:
+                    self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+            def do_POST(self):
+                if self.path != '/segment':
+                    self.send_json(404, {'error': f'Unknown path {self.path}'})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    input_files = request['input_files']
+                    output_directory = request['output_directory']
+                except (ValueError, KeyError, TypeError) as e:
+                    self.send_json(400, {'error': f'Invalid request: {e}'})
+                    return
+                job = server.submit(
+                    input_files,
+                    output_directory,
+                    request.get('mode', MuscleFatSegmentator.ARGMAX),
+                    request.get('batch_size', 1),
+                )
+                job.done.wait()
+                if job.error is not None:
+                    self.send_json(500, {'error': job.error, 'timings': job.timings()})
+                else:
+                    self.send_json(200, {'output_segmentation_files': job.output_segmentation_files, 'timings': job.timings()})
+
+            def log_message(self, format, *args):
+                server.logger.info(format % args)
+
+        return RequestHandler
+
+    def start(self):
+        self.logger.info('Loading models...')
+        self.load_models()
+        self.worker = threading.Thread(target=self.run_worker, daemon=True)
+        self.worker.start()
+        self.http_server = ThreadingHTTPServer((self.host, self.port), self.create_request_handler())
+        self.port = self.http_server.server_address[1]
+        self.logger.info(f'Listening on http://{self.host}:{self.port}')
+
+    def serve_forever(self):
+        if self.http_server is None:
+            self.start()
+        try:
+            self.http_server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.server_close()
+            self.http_server = None
+        if self.worker is not None:
+            self.jobs.put(None)
+            self.worker = None
+
+
+class MuscleFatSegmentatorClient:
+
+    def __init__(self, host='127.0.0.1', port=8765, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def url(self, path):
+        return f'http://{self.host}:{self.port}{path}'
+
+    def status(self):
+        with urllib.request.urlopen(self.url('/status'), timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def segment(self, input_files, output_directory, mode=MuscleFatSegmentator.ARGMAX, batch_size=1):
+        """ Sends a segmentation request and returns the server's response, a dictionary with
+        'output_segmentation_files' and per-request 'timings'. Raises RuntimeError on failure
+        """
+        data = json.dumps({
+            'input_files': list(input_files),
+            'output_directory': output_directory,
+            'mode': mode,
+            'batch_size': batch_size,
+        }).encode('utf-8')
+        request = urllib.request.Request(
+            self.url('/segment'), data=data, headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(json.loads(e.read()).get('error', str(e)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_files', help='Model files (model.zip, contour_model.zip, params.json)', nargs='+')
+    parser.add_argument('--host', help='Host to listen on (default: 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on (default: 8765)', default=8765, type=int)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = MuscleFatSegmentatorServer(args.model_files, host=args.host, port=args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
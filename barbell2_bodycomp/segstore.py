@@ -0,0 +1,150 @@
+import os
+import json
+import argparse
+import logging
+import numpy as np
+
+# Stores opened in this process, keyed by directory, so their memory maps are shared
+_stores = {}
+
+
+class SegmentationStore:
+    """ Stores many uint8 label maps in a single append-only file (labels.u8) with a sidecar index
+    (index.jsonl) of name -> source path, byte offset and shape. Names are DICOM file names, as
+    used for per-file outputs (<name>.seg.npy). Label maps are read as zero-copy views of one
+    read-only memory map. If a name is appended more than once the last label map wins. The store
+    supports a single writer.
+    """
+    DATA_FILE_NAME = 'labels.u8'
+    INDEX_FILE_NAME = 'index.jsonl'
+
+    def __init__(self, directory, logger=None):
+        self.directory = directory
+        self.data_file = os.path.join(directory, SegmentationStore.DATA_FILE_NAME)
+        self.index_file = os.path.join(directory, SegmentationStore.INDEX_FILE_NAME)
+        self.entries = {}
+        self.data = None
+        self.data_writer = None
+        self.index_writer = None
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.load_index()
+
+    @staticmethod
+    def get(directory, logger=None):
+        """ Returns the store for the given directory, reusing the one opened in this process """
+        store = _stores.get(directory)
+        if store is None:
+            store = SegmentationStore(directory, logger)
+            _stores[directory] = store
+        return store
+
+    @staticmethod
+    def is_store(directory):
+        return os.path.isfile(os.path.join(directory, SegmentationStore.INDEX_FILE_NAME))
+
+    def load_index(self):
+        self.entries = {}
+        if not os.path.isfile(self.index_file):
+            return
+        data_size = os.path.getsize(self.data_file) if os.path.isfile(self.data_file) else 0
+        with open(self.index_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Incomplete last line of an interrupted writer
+                    continue
+                if entry['offset'] + int(np.prod(entry['shape'])) <= data_size:
+                    self.entries[entry['name']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def append(self, name, labels, source=None):
+        """ Appends a label map (values 0-255) under the given name and returns its index entry """
+        labels = np.ascontiguousarray(labels)
+        if labels.dtype != np.uint8:
+            if labels.size > 0 and (labels.min() < 0 or labels.max() > 255):
+                raise ValueError(f'Label values of {name} do not fit in uint8')
+            labels = labels.astype(np.uint8)
+        if self.data_writer is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.data_writer = open(self.data_file, 'ab')
+            self.index_writer = open(self.index_file, 'a')
+        offset = self.data_writer.seek(0, os.SEEK_END)
+        self.data_writer.write(labels.data)
+        entry = {'name': name, 'source': source, 'offset': offset, 'shape': list(labels.shape)}
+        # Data is written before its index entry, so readers never see an entry without data
+        self.data_writer.flush()
+        self.index_writer.write(json.dumps(entry) + '\n')
+        self.index_writer.flush()
+        self.entries[name] = entry
+        return entry
+
+    def close(self):
+        for f in (self.data_writer, self.index_writer):
+            if f is not None:
+                f.close()
+        self.data_writer, self.index_writer = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_labels(self, name):
+        """ Returns the label map for name as a read-only view of the store's memory map """
+        entry = self.entries.get(name)
+        if entry is None:
+            # Another process may have appended it since the index was loaded
+            self.load_index()
+            entry = self.entries.get(name)
+            if entry is None:
+                raise KeyError(name)
+        size = int(np.prod(entry['shape']))
+        if self.data is None or entry['offset'] + size > len(self.data):
+            self.data = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        return self.data[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+
+    def import_files(self, segmentation_files, extension='.seg.npy'):
+        """ Appends existing per-file label maps (<name>.seg.npy) to the store. Returns the names """
+        names = []
+        for segmentation_file in segmentation_files:
+            file_name = os.path.split(segmentation_file)[1]
+            if not file_name.endswith(extension):
+                self.logger.warning(f'Skipping {segmentation_file}, only {extension} label maps can be imported')
+                continue
+            name = file_name[:-len(extension)]
+            self.append(name, np.load(segmentation_file, mmap_mode='r'), source=segmentation_file)
+            names.append(name)
+        return names
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', help='Segmentation store directory')
+    parser.add_argument('--import_dir', help='Directory with .seg.npy files to import into the store')
+    args = parser.parse_args()
+    if args.store is None:
+        raise RuntimeError('store cannot be empty')
+    if args.import_dir is None:
+        raise RuntimeError('import_dir cannot be empty')
+    segmentation_files = sorted([
+        os.path.join(args.import_dir, f) for f in os.listdir(args.import_dir) if f.endswith('.seg.npy')])
+    with SegmentationStore(args.store) as store:
+        names = store.import_files(segmentation_files)
+    print(f'imported {len(names)} label maps into {args.store}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 import os
 import logging
-import pydicom
-import nibabel
 import numpy as np
 
+from barbell2_bodycomp.dicomindex import DicomSeriesIndex
+from barbell2_bodycomp.utils import read_dicom_header
+
 
 class SliceSelector:
 
@@ -17,6 +18,7 @@ class SliceSelector:
         self.input_roi = None
         self.input_volume = None
         self.input_dicom_directory = None
+        self.input_series_instance_uid = None   # (Optional) series to select from if directory has multiple
         self.mode = SliceSelector.MEDIAN
         self.output_files = None
         if logger:
@@ -30,21 +32,46 @@ class SliceSelector:
         return False
 
     @staticmethod
-    def get_min_max_slice_idx(roi):
-        roi_data = roi.get_fdata()
-        nr_slices = roi_data.shape[2]
-        i_min = -1
-        for i in range(nr_slices):
-            slice = roi_data[:,:,i]
-            if 1 in np.unique(slice):
-                i_min = i
-                break
-        i_max = -1
-        for i in range(nr_slices):
-            slice = roi_data[:,:,nr_slices-i-1]
-            if 1 in np.unique(slice):
-                i_max = nr_slices - i
-                break
+    def iterate_slabs(roi, slab_size):
+        """ Yields (start, slab) for consecutive slabs of slab_size slices. Images on disk are read
+        as one sequential stream, so a .nii.gz file is decompressed only once, instead of slicing
+        the data proxy which decompresses from the start of the file for every slab
+        """
+        import nibabel as nib
+        dataobj = roi.dataobj
+        nr_rows, nr_columns, nr_slices = roi.shape[:3]
+        if not nib.is_proxy(dataobj) or getattr(dataobj, 'order', 'F') != 'F' or not hasattr(dataobj, 'file_like'):
+            for start in range(0, nr_slices, slab_size):
+                yield start, np.asarray(dataobj[:, :, start:start + slab_size])
+            return
+        dtype = np.dtype(dataobj.dtype)
+        slope, inter = dataobj.slope, dataobj.inter
+        with nib.openers.ImageOpener(dataobj.file_like) as f:
+            f.seek(dataobj.offset)
+            for start in range(0, nr_slices, slab_size):
+                n = min(slab_size, nr_slices - start)
+                slab = np.frombuffer(f.read(nr_rows * nr_columns * n * dtype.itemsize), dtype=dtype)
+                slab = slab.reshape((nr_rows, nr_columns, n), order='F')
+                if slope != 1 or inter != 0:
+                    slab = slab * slope + inter
+                yield start, slab
+
+    @staticmethod
+    def get_min_max_slice_idx(roi, max_slab_bytes=64 * 1024 * 1024):
+        """ Returns the index of the first slice containing the ROI and the index just past the
+        last one, or -1 for both if the ROI is empty. The ROI is read in slabs of slices so the
+        full volume is never loaded into memory
+        """
+        nr_rows, nr_columns = roi.shape[:2]
+        slice_bytes = nr_rows * nr_columns * max(roi.get_data_dtype().itemsize, 8)
+        slab_size = max(1, max_slab_bytes // slice_bytes)
+        i_min, i_max = -1, -1
+        for start, slab in SliceSelector.iterate_slabs(roi, slab_size):
+            idx = np.flatnonzero((slab == 1).any(axis=(0, 1)))
+            if len(idx) > 0:
+                if i_min == -1:
+                    i_min = start + int(idx[0])
+                i_max = start + int(idx[-1]) + 1
         return i_min, i_max
 
     @staticmethod
@@ -60,24 +87,21 @@ class SliceSelector:
 
     @staticmethod
     def get_dicom_z(file_path):
-        p = pydicom.dcmread(file_path, stop_before_pixels=True)
+        p = read_dicom_header(file_path, ['ImagePositionPatient'])
         return p.ImagePositionPatient[2]
 
+    def get_dicom_series(self, dicom_directory):
+        index = DicomSeriesIndex.get(dicom_directory, self.logger)
+        return index.get_series(self.input_series_instance_uid)
+
     def get_dicom_images_between(self, z_min, z_max, dicom_directory):
-        z_coords = {}
-        for f in os.listdir(dicom_directory):
-            f_path = os.path.join(dicom_directory, f)
-            z = self.get_dicom_z(f_path)
-            z_coords[z] = f_path
-        z_min_nearest = min(list(z_coords.keys()), key=lambda x:abs(x - z_min))
-        z_max_nearest = min(list(z_coords.keys()), key=lambda x:abs(x - z_max))
-        file_paths = []
-        for z in z_coords.keys():
-            if z_min_nearest <= z <= z_max_nearest:
-                file_paths.append(z_coords[z])
-        return file_paths
+        series = self.get_dicom_series(dicom_directory)
+        if series is None:
+            return []
+        return series.get_files_between(z_min, z_max)
 
     def execute(self):
+        import nibabel
         self.logger.info('Running SliceSelector...')
         if self.input_roi is None:
             self.logger.error('Input ROI not specified')
@@ -101,10 +125,11 @@ class SliceSelector:
         self.output_files = []
         if self.mode == SliceSelector.ALL or self.mode == SliceSelector.TOP or self.mode == SliceSelector.BOTTOM:
             self.output_files = self.get_dicom_images_between(z_min, z_max, self.input_dicom_directory)
+            # Files are sorted by ascending z so the top (most cranial) slice is the last one
             if self.mode == SliceSelector.TOP:
-                self.output_files = [self.output_files[0]]
-            elif self.mode == SliceSelector.BOTTOM:
                 self.output_files = [self.output_files[-1]]
+            elif self.mode == SliceSelector.BOTTOM:
+                self.output_files = [self.output_files[0]]
             else:
                 self.logger.error('Unknown mode {}'.format(self.mode))
                 self.output_files = []
@@ -126,10 +151,15 @@ class SliceSelector:
         return self.output_files
 
     def get_dicom_image_at_instance_number(self, instance_number):
-        for f in os.listdir(self.input_dicom_directory):
-            f_path = os.path.join(self.input_dicom_directory, f)
-            p = pydicom.dcmread(f_path, stop_before_pixels=True)
-            if p.InstanceNumber == instance_number:
+        index = DicomSeriesIndex.get(self.input_dicom_directory, self.logger)
+        series = index.get_series(self.input_series_instance_uid)
+        if series is not None:
+            f_path = series.get_file_at_instance_number(instance_number)
+            if f_path is not None:
+                return f_path
+        for series in index.series.values():
+            f_path = series.get_file_at_instance_number(instance_number)
+            if f_path is not None:
                 return f_path
         return None
 
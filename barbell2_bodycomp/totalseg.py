@@ -1,8 +1,18 @@
 import os
+import time
+import shutil
 import logging
+import subprocess
+import concurrent.futures
 
 
 class TotalSegmentator:
+    OK = 'ok'
+    FAILED = 'failed'
+    CACHED = 'cached'
+    SKIPPED = 'skipped'
+    THREAD_ENVIRONMENT_VARIABLES = [
+        'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
 
     def __init__(self, logger=None):
         self.input_file = None
@@ -11,7 +21,12 @@ class TotalSegmentator:
         self.statistics = False
         # self.radiomics = False
         self.overwrite = True
+        self.threads = None     # (Optional) Maximum number of threads TotalSegmentator may use
+        self.cache = None       # (Optional) ArtifactCache to reuse outputs for identical input and flags
         self.cmd = None
+        self.status = None
+        self.returncode = None
+        self.elapsed_secs = None
         if logger:
             self.logger = logger
         else:
@@ -21,38 +36,161 @@ class TotalSegmentator:
     def is_empty(directory):
         return len(os.listdir(directory)) == 0
 
+    @staticmethod
+    def is_output_file(f):
+        return f.endswith('.nii.gz') or f.endswith('.nii') or f == 'statistics.json'
+
+    @staticmethod
+    def remove_outputs(directory, linked_only=False):
+        """ Deletes TotalSegmentator outputs in directory, or with linked_only=True only those hardlinked
+        to the artifact cache so they are not overwritten in place. Other files are left alone
+        """
+        if not os.path.isdir(directory):
+            return
+        for f in os.listdir(directory):
+            f_path = os.path.join(directory, f)
+            if not TotalSegmentator.is_output_file(f) or not os.path.isfile(f_path):
+                continue
+            if not linked_only or os.stat(f_path).st_nlink > 1:
+                os.remove(f_path)
+
+    def get_command(self):
+        cmd = ['TotalSegmentator']
+        if self.statistics:
+            cmd.append('--statistics')
+        # if self.radiomics:
+        #     cmd.append('--radiomics')
+        if self.fast:
+            cmd.append('--fast')
+        if self.threads is not None:
+            cmd.extend(['--nr_thr_resamp', str(self.threads), '--nr_thr_saving', str(self.threads)])
+        cmd.extend(['-i', self.input_file, '-o', self.output_directory])
+        return cmd
+
+    def get_environment(self):
+        """ Returns the environment for the TotalSegmentator process. If threads is set, the math
+        libraries' thread pools are capped so concurrent jobs do not each use all cores
+        """
+        env = dict(os.environ)
+        if self.threads is not None:
+            for name in TotalSegmentator.THREAD_ENVIRONMENT_VARIABLES:
+                env[name] = str(self.threads)
+        return env
+
     def execute(self):
         self.logger.info('Running TotalSegmentator...')
+        self.status, self.returncode, self.elapsed_secs = None, None, None
         if self.input_file is None:
             self.logger.error('Input NIFTI file not specified')
             return None
         if self.output_directory is None:
             self.logger.error('Output directory not specified')
             return None
-        if not self.overwrite and not self.is_empty(self.output_directory):
+        if not self.overwrite and os.path.isdir(self.output_directory) and not self.is_empty(self.output_directory):
             self.logger.info('Overwrite = False and output directory not empty, so skipping')
+            self.status = TotalSegmentator.SKIPPED
             return self.output_directory
-        fast = ''
-        if self.fast:
-            fast = '--fast'
-        statistics = ''
-        if self.statistics:
-            statistics = '--statistics'
-        radiomics = ''
-        # if self.radiomics:
-        #     radiomics = '--radiomics'
-        self.cmd = 'TotalSegmentator {} {} {} -i {} -o {}'.format(
-            statistics, 
-            radiomics,
-            fast,
-            self.input_file,
-            self.output_directory,
-        )
+        start = time.perf_counter()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.get_key(
+                [self.input_file], {'cmd': 'TotalSegmentator', 'fast': self.fast, 'statistics': self.statistics})
+            if self.cache.contains(cache_key):
+                # Remove outputs of a previous run that the cache entry may not have, e.g., statistics.json
+                self.remove_outputs(self.output_directory)
+            if self.cache.get(cache_key, self.output_directory):
+                self.logger.info(f'Found output in cache ({cache_key})')
+                self.status = TotalSegmentator.CACHED
+                self.elapsed_secs = time.perf_counter() - start
+                return self.output_directory
+        self.remove_outputs(self.output_directory, linked_only=True)
+        cmd = self.get_command()
+        self.cmd = ' '.join(cmd)
         self.logger.info(f'Running command: {self.cmd}')
-        os.system(self.cmd)
+        try:
+            result = subprocess.run(cmd, env=self.get_environment(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.returncode = result.returncode
+            output = result.stdout.decode(errors='replace')
+        except OSError as e:
+            output = str(e)
+        self.elapsed_secs = time.perf_counter() - start
+        if self.returncode != 0 or not os.path.isdir(self.output_directory) or self.is_empty(self.output_directory):
+            self.logger.error(f'TotalSegmentator failed for {self.input_file} (exit status {self.returncode}): {output}')
+            self.status = TotalSegmentator.FAILED
+            return None
+        self.status = TotalSegmentator.OK
+        if cache_key is not None:
+            self.cache.put(cache_key, self.output_directory)
         return self.output_directory
 
 
+class TotalSegmentatorBatch:
+    """ Runs TotalSegmentator for a list of (input NIfTI file, output directory) jobs with at most
+    max_concurrent_jobs processes at a time. Each process is limited to threads_per_job threads
+    (default: number of CPUs divided by max_concurrent_jobs). The summary has the status, exit
+    status and wall time of each job
+    """
+    def __init__(self, logger=None):
+        self.jobs = None
+        self.max_concurrent_jobs = 1
+        self.threads_per_job = None
+        self.fast = False
+        self.statistics = False
+        self.overwrite = True
+        self.cache = None
+        self.summary = None
+        self.elapsed_secs = None
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+    def get_threads_per_job(self):
+        if self.threads_per_job is not None:
+            return self.threads_per_job
+        return max(1, (os.cpu_count() or 1) // max(1, self.max_concurrent_jobs))
+
+    def run_job(self, job):
+        input_file, output_directory = job
+        os.makedirs(output_directory, exist_ok=True)
+        totalseg = TotalSegmentator(logger=self.logger)
+        totalseg.input_file = input_file
+        totalseg.output_directory = output_directory
+        totalseg.fast = self.fast
+        totalseg.statistics = self.statistics
+        totalseg.overwrite = self.overwrite
+        totalseg.cache = self.cache
+        totalseg.threads = self.get_threads_per_job()
+        totalseg.execute()
+        return {
+            'input_file': input_file,
+            'output_directory': output_directory,
+            'status': totalseg.status,
+            'returncode': totalseg.returncode,
+            'elapsed_secs': totalseg.elapsed_secs,
+        }
+
+    def execute(self):
+        self.logger.info('Running TotalSegmentatorBatch...')
+        if self.jobs is None:
+            self.logger.error('Jobs not specified')
+            return None
+        start = time.perf_counter()
+        # Jobs are separate processes, threads are only needed to wait for them
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.max_concurrent_jobs)) as executor:
+            self.summary = list(executor.map(self.run_job, self.jobs))
+        self.elapsed_secs = time.perf_counter() - start
+        nr_failed = len([x for x in self.summary if x['status'] == TotalSegmentator.FAILED])
+        self.logger.info(f'Finished {len(self.summary)} jobs in {self.elapsed_secs:.1f}s, {nr_failed} failed')
+        return self.summary
+
+    def as_df(self):
+        import pandas as pd
+        if self.summary is None:
+            return None
+        return pd.DataFrame(self.summary)
+
+
 if __name__ == '__main__':
     def main():
         pass
@@ -1,9 +1,15 @@
 import os
+import re
+import gzip
+import zlib
 import time
+import struct
 import math
+import mmap
+import logging
 import datetime
-import struct
-import binascii
+import tempfile
+import concurrent.futures
 import numpy as np
 
 
@@ -100,12 +106,116 @@ def get_numpy_file_for_dicom(dcm_file):
     return get_tag_file_for_dicom(dcm_file, ext='.npy')
 
 
-def get_pixels(p, normalize=False):
+# Column types used by scan_dicom_headers(), tags not listed here are stored as strings
+DICOM_HEADER_DTYPES = {
+    'ImagePositionPatient': (np.float64, (3,)),
+    'ImageOrientationPatient': (np.float64, (6,)),
+    'PixelSpacing': (np.float64, (2,)),
+    'SliceLocation': np.float64,
+    'SliceThickness': np.float64,
+    'RescaleSlope': np.float64,
+    'RescaleIntercept': np.float64,
+    'InstanceNumber': np.int64,
+    'Rows': np.int64,
+    'Columns': np.int64,
+    # Strings (e.g., UIDs) are sized from the values read, see scan_dicom_headers
+    'SOPInstanceUID': str,
+    'SeriesInstanceUID': str,
+    'StudyInstanceUID': str,
+}
+
+
+def read_dicom_header(file_path, tags):
+    """ Reads only the given tags (keywords) from a DICOM file and stops before the pixel data """
+    import pydicom
+    return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=tags)
+
+
+def scan_dicom_headers(file_paths, tags, workers=16):
+    """ Reads the given tags from many DICOM files on a thread pool and returns a NumPy structured
+    array with columns 'file_path', 'valid' and one column per tag, in the order of file_paths.
+    Missing float values are NaN, missing integers -1 and missing strings empty. String columns
+    (e.g., UIDs) are as wide as the longest value read. Rows of files that could not be read as
+    DICOM, or whose header is truncated or malformed, have valid=False. Threads help most on
+    network file systems where reads are dominated by I/O latency.
+    """
+    from pydicom.errors import InvalidDicomError
+    logger = logging.getLogger(__name__)
+    file_paths = list(file_paths)
+
+    def read(file_path):
+        try:
+            p = read_dicom_header(file_path, tags)
+            # Values are converted on access, so malformed elements raise here
+            return [p.get(tag) for tag in tags]
+        except (InvalidDicomError, OSError, EOFError, AttributeError, IndexError, TypeError, ValueError) as e:
+            logger.warning(f'Skipping {file_path}, could not read DICOM header: {e}')
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        rows = list(executor.map(read, file_paths))
+    dtype = [('file_path', f'U{max([len(f) for f in file_paths] + [1])}'), ('valid', bool)]
+    for j, tag in enumerate(tags):
+        tag_dtype = DICOM_HEADER_DTYPES.get(tag, str)
+        if tag_dtype is str:
+            tag_dtype = f'U{max([len(str(row[j])) for row in rows if row is not None and row[j] is not None] + [1])}'
+        dtype.append((tag, tag_dtype))
+    headers = np.zeros(len(file_paths), dtype=dtype)
+    headers['file_path'] = file_paths
+    for tag in tags:
+        kind = headers.dtype[tag].base.kind
+        if kind == 'f':
+            headers[tag] = np.nan
+        elif kind == 'i':
+            headers[tag] = -1
+    for i, row in enumerate(rows):
+        if row is None:
+            continue
+        headers['valid'][i] = True
+        for tag, value in zip(tags, row):
+            if value is None or value == '':
+                continue
+            try:
+                headers[tag][i] = value if headers.dtype[tag].base.kind != 'U' else str(value)
+            except (TypeError, ValueError):
+                pass
+    return headers
+
+
+def get_rescale_dtype(slope, intercept):
+    """ Returns int16 if slope and intercept are integral (so HU values are exact integers), otherwise float32 """
+    if float(slope).is_integer() and float(intercept).is_integer():
+        return np.dtype(np.int16)
+    return np.dtype(np.float32)
+
+
+def rescale_pixels(pixels, slope=1, intercept=0, dtype=None, out=None):
+    """ Returns slope * pixels + intercept (HU for CT) without float64 temporaries. The result is
+    written to out if given, otherwise to a new array of the given dtype (default: see
+    get_rescale_dtype). The multiplication is skipped if slope is 1
+    """
+    slope, intercept = float(slope), float(intercept)
+    if out is None:
+        out = np.empty(pixels.shape, dtype=dtype or get_rescale_dtype(slope, intercept))
+    if out.dtype.kind in 'iu' and not (slope.is_integer() and intercept.is_integer()):
+        np.rint(pixels * slope + intercept, out=out, casting='unsafe')
+        return out
+    # Scalars in the output dtype so the ufuncs do not promote to float64/int64
+    slope, intercept = out.dtype.type(slope), out.dtype.type(intercept)
+    if slope == 1:
+        np.add(pixels, intercept, out=out, casting='unsafe')
+    else:
+        np.multiply(pixels, slope, out=out, casting='unsafe')
+        np.add(out, intercept, out=out)
+    return out
+
+
+def get_pixels(p, normalize=False, dtype=None, out=None):
     pixels = p.pixel_array
     if not normalize:
         return pixels
     if normalize is True:
-        return p.RescaleSlope * pixels + p.RescaleIntercept
+        return rescale_pixels(pixels, p.RescaleSlope, p.RescaleIntercept, dtype, out)
     if isinstance(normalize, int):
         return (pixels + np.min(pixels)) / (np.max(pixels) - np.min(pixels)) * normalize
     if isinstance(normalize, list):
@@ -113,76 +223,243 @@ def get_pixels(p, normalize=False):
     return pixels
 
 
-def get_tag_pixels(tag_file_path):
-    f = open(tag_file_path, 'rb')
-    f.seek(0)
-    byte = f.read(1)
-    # Make sure to check the byte-value in Python 3!!
-    while byte != b'':
-        byte_hex = binascii.hexlify(byte)
-        if byte_hex == b'0c':
-            break
-        byte = f.read(1)
-    values = []
-    f.read(1)
-    while byte != b'':
-        v = struct.unpack('b', byte)
-        values.append(v)
-        byte = f.read(1)
-    values = np.asarray(values)
-    values = values.astype(np.uint16)
-    return values
+TAG_HEADER_TERMINATOR = b'\x0c'
 
 
-def get_alberta_color_map():
-    color_map = []
-    for i in range(256):
-        if i == 1:  # muscle
-            color_map.append([255, 0, 0])
-        elif i == 2:  # inter-muscular adipose tissue
-            color_map.append([0, 255, 0])
-        elif i == 5:  # visceral adipose tissue
-            color_map.append([255, 255, 0])
-        elif i == 7:  # subcutaneous adipose tissue
-            color_map.append([0, 255, 255])
-        elif i == 12:  # unknown
-            color_map.append([0, 0, 255])
-        else:
-            color_map.append([0, 0, 0])
-    return color_map
+def find_tag_header_end(buffer):
+    """ Returns the offset of the form-feed byte that terminates the ASCII header of a
+    TomoVision TAG file, or -1 if there is none. The label payload starts right after it.
+    """
+    return buffer.find(TAG_HEADER_TERMINATOR)
 
 
-def update_labels(pixels):
-    # http://www.tomovision.com/Sarcopenia_Help/index.htm
-    labels_to_keep = [0, 1, 5, 7]
-    labels_to_remove = [2, 12, 14]
-    for label in np.unique(pixels):
-        if label in labels_to_remove:
-            pixels[pixels == label] = 0
-    for label in np.unique(pixels):
-        if label not in labels_to_keep:
-            return None
-    if len(np.unique(pixels)) != 4:
-        print('Incorrect nr. of labels: {}'.format(len(np.unique(pixels))))
+def parse_tag_header(header):
+    """ Parses 'key: value' tokens from a TAG file header into a dictionary. Keys are
+    lower-case strings, values are strings.
+    """
+    if isinstance(header, (bytes, bytearray, memoryview)):
+        header = bytes(header).decode('ASCII', errors='ignore')
+    items = {}
+    for key, value in re.findall(r'([A-Za-z_][A-Za-z0-9_]*)\s*[:=]\s*([^\s:=]+)', header):
+        items[key.lower()] = value
+    return items
+
+
+def get_tag_shape(header_items):
+    """ Returns (rows, columns) from a parsed TAG header or None if the header does not
+    specify width and height.
+    """
+    try:
+        return int(header_items['height']), int(header_items['width'])
+    except (KeyError, ValueError):
         return None
-    return pixels
 
 
-def apply_window(pix, window):
-    result = (pix - window[1] + 0.5 * window[0])/window[0]
-    result[result < 0] = 0
-    result[result > 1] = 1
-    return result
+def get_tag_pixels(tag_file_path, shape=None, mmap_mode=None):
+    """ Reads the label map of a TAG file as a uint8 array. The shape is taken from the TAG
+    header unless it is given explicitly. If the header has no dimensions and no shape is
+    given, a flat array is returned. With mmap_mode (e.g., 'r' or 'c') the payload is memory-mapped
+    instead of read into memory.
+    """
+    with open(tag_file_path, 'rb') as f:
+        if mmap_mode is None:
+            # A bytearray keeps the returned array writable without another copy of the file
+            buffer = bytearray(os.fstat(f.fileno()).st_size)
+            del buffer[f.readinto(buffer):]
+            offset = find_tag_header_end(buffer)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = mm.find(TAG_HEADER_TERMINATOR)
+                buffer = mm[:offset] if offset >= 0 else None
+    if offset < 0:
+        raise ValueError(f'File {tag_file_path} has no TAG header')
+    if shape is None:
+        shape = get_tag_shape(parse_tag_header(buffer[:offset]))
+    if mmap_mode is not None:
+        return np.memmap(tag_file_path, dtype=np.uint8, mode=mmap_mode, offset=offset + 1, shape=shape)
+    values = np.frombuffer(buffer, dtype=np.uint8, offset=offset + 1)
+    if shape is not None:
+        values = values.reshape(shape)
+    return values
 
 
-def apply_color_map(pixels, color_map):
-    pixels_new = np.zeros((*pixels.shape, 3), dtype=np.uint8)
-    np.take(color_map, pixels, axis=0, out=pixels_new)
-    return pixels_new
+def get_tag_pixels_for_directory(tag_directory, shape=None, mmap_mode=None):
+    """ Reads all TAG files in the given directory and returns a dictionary of file path
+    to label map, ordered by file name.
+    """
+    tag_pixels = {}
+    for f in sorted(os.listdir(tag_directory)):
+        if is_tag_file(f):
+            f_path = os.path.join(tag_directory, f)
+            tag_pixels[f_path] = get_tag_pixels(f_path, shape=shape, mmap_mode=mmap_mode)
+    return tag_pixels
+
+
+def create_color_map(colors):
+    """ Creates a read-only (256, 3) uint8 lookup table from a dictionary of label to RGB color,
+    labels not in the dictionary are black
+    """
+    color_map = np.zeros((256, 3), dtype=np.uint8)
+    for label, color in colors.items():
+        color_map[label] = color
+    color_map.flags.writeable = False
+    return color_map
+
+
+ALBERTA_COLOR_MAP = create_color_map({
+    1: [255, 0, 0],  # muscle
+    2: [0, 255, 0],  # inter-muscular adipose tissue
+    5: [255, 255, 0],  # visceral adipose tissue
+    7: [0, 255, 255],  # subcutaneous adipose tissue
+    12: [0, 0, 255],  # unknown
+})
 
+COLOR_MAPS = {
+    'alberta': ALBERTA_COLOR_MAP,
+}
 
-def create_fake_dicom(pixels, dcm_obj):
-    pixels_new = apply_color_map(pixels, get_alberta_color_map())
+
+def get_alberta_color_map():
+    return ALBERTA_COLOR_MAP
+
+
+def get_color_map(name):
+    return COLOR_MAPS[name]
+
+
+def remap_labels(pixels, mapping, allowed_labels=None, nr_labels=None, in_place=False):
+    """ Maps labels (0-255) through a 256-entry lookup table built from the mapping dictionary, labels
+    not in the mapping are kept. The label histogram of the input is used to validate the result
+    before remapping: if allowed_labels is given all remapped labels must be in it and if nr_labels
+    is given there must be exactly that many distinct labels. Returns None if validation fails.
+    With in_place=True writable arrays are remapped in place, read-only arrays (e.g., memory maps)
+    are remapped into a new array.
+    """
+    counts = np.bincount(pixels.ravel(), minlength=256)
+    if len(counts) > 256:
+        raise ValueError('Labels must be in the range 0-255')
+    lut = np.arange(256, dtype=pixels.dtype)
+    for label, new_label in mapping.items():
+        lut[label] = new_label
+    labels = np.unique(lut[np.flatnonzero(counts)])
+    if allowed_labels is not None and not np.isin(labels, allowed_labels).all():
+        print('Unexpected labels: {}'.format(np.setdiff1d(labels, allowed_labels)))
+        return None
+    if nr_labels is not None and len(labels) != nr_labels:
+        print('Incorrect nr. of labels: {}'.format(len(labels)))
+        return None
+    # Each output element only depends on the input element at the same index, so out may be pixels
+    return np.take(lut, pixels, out=pixels if in_place and pixels.flags.writeable else None, mode='clip')
+
+
+def update_labels(pixels):
+    # http://www.tomovision.com/Sarcopenia_Help/index.htm
+    labels_to_keep = [0, 1, 5, 7]
+    labels_to_remove = [2, 12, 14]
+    return remap_labels(
+        pixels, dict.fromkeys(labels_to_remove, 0), allowed_labels=labels_to_keep, nr_labels=4, in_place=True)
+
+
+def apply_window(pix, window, out=None):
+    """ Maps pixel values in window (width, level) to [0, 1] and clips values outside it. The
+    result is written to out if given (out=pix works for float arrays), otherwise to a new float
+    array of the same type as (pix - level) would have
+    """
+    if out is None:
+        out = np.empty(pix.shape, dtype=np.result_type(pix, 1.0))
+    # Same operation order as (pix - level + 0.5 * width) / width so results are identical
+    np.subtract(pix, float(window[1]), out=out, casting='same_kind')
+    np.add(out, 0.5 * float(window[0]), out=out)
+    np.divide(out, float(window[0]), out=out)
+    np.clip(out, 0, 1, out=out)
+    return out
+
+
+def apply_color_map(pixels, color_map, out=None):
+    """ Maps a label map (H, W) or a stack of label maps (N, H, W) to RGB using a (256, 3) color map.
+    The result is written to out if given, which must be a uint8 array of shape (*pixels.shape, 3)
+    """
+    if out is None:
+        out = np.empty((*pixels.shape, 3), dtype=np.uint8)
+    np.take(np.asarray(color_map, dtype=np.uint8), pixels, axis=0, out=out)
+    return out
+
+
+def apply_color_map_overlay(image, pixels, color_map, window=(400, 50), alpha=0.5, out=None):
+    """ Blends a colored label map (H, W) or (N, H, W) onto the windowed CT image of the same shape.
+    Labels with a black color (e.g., background) are left transparent. The RGB result is written to
+    out if given, which must be a uint8 array of shape (*pixels.shape, 3)
+    """
+    color_map = np.asarray(color_map, dtype=np.uint8)
+    alpha_map = np.where(color_map.any(axis=1), np.float32(alpha), np.float32(0))
+    gray = np.asarray(image, dtype=np.float32)
+    if window is not None:
+        gray = apply_window(gray, window)
+    else:
+        gray = (gray - gray.min()) / max(float(gray.max() - gray.min()), 1e-6)
+    a = alpha_map[pixels][..., None]
+    blended = (gray[..., None] * 255.0) * (1.0 - a) + color_map[pixels] * a
+    if out is None:
+        out = np.empty((*pixels.shape, 3), dtype=np.uint8)
+    np.rint(blended, out=blended)
+    np.copyto(out, blended, casting='unsafe')
+    return out
+
+
+def write_png(file_path, pixels, compression_level=6):
+    """ Writes a uint8 grayscale (H, W) or RGB (H, W, 3) array to a PNG file at native resolution """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width = pixels.shape[:2]
+    color_type = 2 if pixels.ndim == 3 else 0
+    # Each scanline starts with a filter type byte (0 = none)
+    scanlines = np.zeros((height, 1 + pixels[0].size), dtype=np.uint8)
+    scanlines[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    with open(file_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression_level)))
+        f.write(chunk(b'IEND', b''))
+    return file_path
+
+
+def set_default_file_mode(file_path):
+    """ Gives a file the permissions a newly created file would get (0o666 minus the umask).
+    Temporary files from tempfile.mkstemp are owner-only, so use this before renaming them into place
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(file_path, 0o666 & ~umask)
+
+
+def write_nifti(image, file_path, compression_level=6):
+    """ Writes a nibabel image to a .nii or .nii.gz file with the given gzip compression level
+    (0-9, ignored for .nii). The file is written to a temporary file first and then renamed
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if file_path.endswith('.gz'):
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=compression_level, mtime=0) as gz:
+                    image.to_stream(gz)
+            else:
+                image.to_stream(f)
+        set_default_file_mode(tmp_file)
+        os.replace(tmp_file, file_path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return file_path
+
+
+def create_fake_dicom(pixels, dcm_obj, color_map=None):
+    if color_map is None:
+        color_map = ALBERTA_COLOR_MAP
+    pixels_new = apply_color_map(pixels, color_map)
     dcm_obj.PhotometricInterpretation = 'RGB'
     dcm_obj.SamplesPerPixel = 3
     dcm_obj.BitsAllocated = 8
@@ -216,3 +493,95 @@ def calculate_mean_radiation_attenuation(image, labels, label):
         print('Sum of mask pixels is zero, return zero radiation attenuation')
         mean_ra = 0.0
     return mean_ra
+
+
+def calculate_label_metrics(image, labels, pixel_spacing, hu_ranges=None):
+    """ Calculates area (cm2), pixel count, mean and standard deviation of radiation attenuation
+    for every label in a single pass over (labels, image). The optional hu_ranges dictionary
+    maps a name to a (min, max) HU range, e.g., {'muscle': (-29, 150), 'imat': (-190, -30)}, and
+    adds '<name>_area' to each label's metrics, i.e., the area of the label within that range.
+    Returns a dictionary of label to metrics dictionary for labels present in the image.
+    """
+    labels = np.asarray(labels).ravel()
+    if labels.dtype.kind not in 'ui':
+        labels = labels.astype(np.intp)
+    image = np.asarray(image, dtype=np.float64).ravel()
+    pixel_area = pixel_spacing[0] * pixel_spacing[1] / 100.0
+    counts = np.bincount(labels)
+    sums = np.bincount(labels, weights=image, minlength=len(counts))
+    sums_squared = np.bincount(labels, weights=image * image, minlength=len(counts))
+    range_counts = {}
+    if hu_ranges:
+        for name, (hu_min, hu_max) in hu_ranges.items():
+            in_range = (image >= hu_min) & (image <= hu_max)
+            range_counts[name] = np.bincount(labels, weights=in_range, minlength=len(counts))
+    metrics = {}
+    for label in np.flatnonzero(counts):
+        n = counts[label]
+        mean = sums[label] / n
+        variance = max(sums_squared[label] / n - mean * mean, 0.0)
+        metrics[int(label)] = {
+            'pixel_count': int(n),
+            'area': float(n * pixel_area),
+            'ra': float(mean),
+            'ra_std': float(np.sqrt(variance)),
+        }
+        for name, range_count in range_counts.items():
+            metrics[int(label)][f'{name}_area'] = float(range_count[label] * pixel_area)
+    return metrics
+
+
+def save_probabilities(file_path, probabilities, encoding=None, compressed=False):
+    """ Saves an (H, W, C) probability map. Encoding None keeps the original dtype (float32),
+    'float16' halves the size and 'uint8' quantizes to 1/255 steps. With compressed=True the map
+    is written to a compressed .npz file instead of .npy. Returns the path of the saved file.
+    """
+    if encoding == 'float16':
+        probabilities = probabilities.astype(np.float16)
+    elif encoding == 'uint8':
+        probabilities = np.rint(np.clip(probabilities, 0, 1) * 255).astype(np.uint8)
+    elif encoding is not None:
+        raise ValueError(f'Unknown probability encoding {encoding}')
+    if compressed:
+        if file_path.endswith('.npy'):
+            file_path = file_path[:-4]
+        if not file_path.endswith('.npz'):
+            file_path = file_path + '.npz'
+        np.savez_compressed(file_path, probabilities=probabilities)
+    else:
+        np.save(file_path, probabilities)
+    return file_path
+
+
+def load_probabilities(file_path):
+    """ Loads a probability map saved by save_probabilities() as float32 """
+    if file_path.endswith('.npz'):
+        with np.load(file_path) as data:
+            probabilities = data['probabilities']
+    else:
+        probabilities = np.load(file_path)
+    if probabilities.dtype == np.uint8:
+        return probabilities.astype(np.float32) / 255.0
+    return probabilities.astype(np.float32, copy=False)
+
+
+def is_probability_file(file_path):
+    return file_path.endswith('.seg.prob.npy') or file_path.endswith('.seg.prob.npz')
+
+
+def calculate_probability_metrics(image, probabilities, pixel_spacing):
+    """ Calculates soft area (cm2) and probability-weighted mean radiation attenuation for every
+    channel of an (H, W, C) probability map. Returns a dictionary of channel to metrics dictionary.
+    """
+    probabilities = probabilities.reshape(-1, probabilities.shape[-1])
+    image = np.asarray(image, dtype=np.float64).ravel()
+    pixel_area = pixel_spacing[0] * pixel_spacing[1] / 100.0
+    weights = probabilities.sum(axis=0, dtype=np.float64)
+    weighted_sums = image @ probabilities.astype(np.float64, copy=False)
+    metrics = {}
+    for channel in range(probabilities.shape[-1]):
+        metrics[channel] = {
+            'area': float(weights[channel] * pixel_area),
+            'ra': float(weighted_sums[channel] / weights[channel]) if weights[channel] > 0 else 0.0,
+        }
+    return metrics
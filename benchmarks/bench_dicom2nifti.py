@@ -0,0 +1,97 @@
+""" Compares DicomToNifti with dcm2niix against the in-process Python engine (at several gzip
+compression levels) on a CT series. Without --dicom_dir a synthetic 500-slice 512x512 series is
+written to a temporary directory. dcm2niix is skipped if it is not installed.
+
+Usage: python benchmarks/bench_dicom2nifti.py [--dicom_dir <dir>] [--nr_files 500] [--workers 8]
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from barbell2_bodycomp.convert.dcm2nifti import DicomToNifti
+
+
+def write_series(directory, nr_files):
+    yy, xx = np.mgrid[:512, :512]
+    body = ((yy - 256) ** 2 + (xx - 256) ** 2) < 200 ** 2
+    series_instance_uid = generate_uid()
+    for i in range(nr_files):
+        pixels = np.where(body, np.random.randint(900, 1200, (512, 512)), 0).astype(np.int16)
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        p = Dataset()
+        p.file_meta = file_meta
+        p.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        p.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        p.SeriesInstanceUID = series_instance_uid
+        p.StudyInstanceUID = generate_uid()
+        p.Modality = 'CT'
+        p.InstanceNumber = i + 1
+        p.ImagePositionPatient = [-250.0, -250.0, -1.0 * i]
+        p.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        p.PixelSpacing = [0.78, 0.78]
+        p.SliceThickness = 1.0
+        p.RescaleSlope, p.RescaleIntercept = 1, -1024
+        p.Rows, p.Columns = 512, 512
+        p.SamplesPerPixel = 1
+        p.PhotometricInterpretation = 'MONOCHROME2'
+        p.BitsAllocated, p.BitsStored, p.HighBit, p.PixelRepresentation = 16, 16, 15, 1
+        p.PixelData = pixels.tobytes()
+        p.save_as(os.path.join(directory, f'{i:05d}.dcm'), enforce_file_format=True)
+
+
+def convert(dicom_dir, output_file, engine, compression_level=6, workers=8):
+    dicom2nifti = DicomToNifti()
+    dicom2nifti.input_directory = dicom_dir
+    dicom2nifti.output_file = output_file
+    dicom2nifti.engine = engine
+    dicom2nifti.compression_level = compression_level
+    dicom2nifti.workers = workers
+    start = time.perf_counter()
+    result = dicom2nifti.execute()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dicom_dir', help='Directory containing a DICOM series (default: synthetic series)')
+    parser.add_argument('--nr_files', help='Number of synthetic files (default: 500)', default=500, type=int)
+    parser.add_argument('--workers', help='Number of threads for the Python engine (default: 8)', default=8, type=int)
+    args = parser.parse_args()
+    import nibabel as nib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dicom_dir = args.dicom_dir
+        if dicom_dir is None:
+            dicom_dir = os.path.join(tmp_dir, 'dicom')
+            os.makedirs(dicom_dir)
+            write_series(dicom_dir, args.nr_files)
+        runs = [('python', DicomToNifti.PYTHON, 'python0.nii', 0)]
+        runs.extend([(f'python -z {level}', DicomToNifti.PYTHON, f'python{level}.nii.gz', level) for level in [1, 6]])
+        if DicomToNifti.is_dcm2niix_installed():
+            runs.append(('dcm2niix -z y', DicomToNifti.DCM2NIIX, 'dcm2niix.nii.gz', 6))
+        else:
+            print('dcm2niix not installed, skipping')
+        reference = None
+        for name, engine, file_name, level in runs:
+            elapsed, output_file = convert(dicom_dir, os.path.join(tmp_dir, file_name), engine, level, args.workers)
+            if output_file is None:
+                print(f'{name:>16}: failed')
+                continue
+            data = np.asanyarray(nib.load(output_file).dataobj)
+            if reference is None:
+                reference = data
+            # dcm2niix may flip rows, so compare sorted voxel values
+            identical = data.shape == reference.shape and np.array_equal(np.sort(data, axis=None), np.sort(reference, axis=None))
+            size = os.path.getsize(output_file) / 1024 ** 2
+            print(f'{name:>16}: {elapsed:.2f}s, {size:.1f} MB, identical={identical}')
+
+
+if __name__ == '__main__':
+    main()
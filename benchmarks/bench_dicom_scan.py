@@ -0,0 +1,81 @@
+""" Compares reading ImagePositionPatient and PixelSpacing from a DICOM series with a serial full
+dcmread per file against utils.scan_dicom_headers. Without --dicom_dir a synthetic 1000-file
+512x512 CT series is written to a temporary directory.
+
+Usage: python benchmarks/bench_dicom_scan.py [--dicom_dir <dir>] [--nr_files 1000] [--workers 16]
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pydicom
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from barbell2_bodycomp.utils import scan_dicom_headers
+
+TAGS = ['ImagePositionPatient', 'PixelSpacing']
+
+
+def write_series(directory, nr_files):
+    pixels = np.random.randint(-1024, 2000, (512, 512)).astype(np.int16).tobytes()
+    series_instance_uid = generate_uid()
+    for i in range(nr_files):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        p = Dataset()
+        p.file_meta = file_meta
+        p.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        p.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        p.SeriesInstanceUID = series_instance_uid
+        p.InstanceNumber = i + 1
+        p.ImagePositionPatient = [-250.0, -250.0, -1.0 * i]
+        p.PixelSpacing = [0.78, 0.78]
+        p.Rows, p.Columns = 512, 512
+        p.SamplesPerPixel = 1
+        p.PhotometricInterpretation = 'MONOCHROME2'
+        p.BitsAllocated, p.BitsStored, p.HighBit, p.PixelRepresentation = 16, 16, 15, 1
+        p.PixelData = pixels
+        p.save_as(os.path.join(directory, f'{i:05d}.dcm'), enforce_file_format=True)
+
+
+def scan_serial(file_paths):
+    z, pixel_spacing = [], []
+    for f in file_paths:
+        p = pydicom.dcmread(f)
+        z.append(float(p.ImagePositionPatient[2]))
+        pixel_spacing.append([float(x) for x in p.PixelSpacing])
+    return np.array(z), np.array(pixel_spacing)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dicom_dir', help='Directory containing a DICOM series (default: synthetic series)')
+    parser.add_argument('--nr_files', help='Number of synthetic files (default: 1000)', default=1000, type=int)
+    parser.add_argument('--workers', help='Number of threads (default: 16)', default=16, type=int)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dicom_dir = args.dicom_dir
+        if dicom_dir is None:
+            dicom_dir = tmp_dir
+            write_series(dicom_dir, args.nr_files)
+        file_paths = sorted([os.path.join(dicom_dir, f) for f in os.listdir(dicom_dir)])
+        start = time.perf_counter()
+        z, pixel_spacing = scan_serial(file_paths)
+        elapsed_serial = time.perf_counter() - start
+        start = time.perf_counter()
+        headers = scan_dicom_headers(file_paths, TAGS, workers=args.workers)
+        elapsed_scan = time.perf_counter() - start
+        identical = np.array_equal(z, headers['ImagePositionPatient'][:, 2]) and \
+            np.array_equal(pixel_spacing, headers['PixelSpacing'])
+        print(f'{len(file_paths)} files')
+        print(f'   serial dcmread: {elapsed_serial:.2f}s')
+        print(f'   scan_dicom_headers ({args.workers} threads): {elapsed_scan:.2f}s, identical={identical}')
+
+
+if __name__ == '__main__':
+    main()
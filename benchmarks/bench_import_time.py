@@ -0,0 +1,51 @@
+""" Measures cold import times in fresh interpreters and exits with status 1 if a budget is
+exceeded or if a heavy dependency gets imported eagerly.
+
+Usage: python benchmarks/bench_import_time.py [--budget_ms 50] [--repeat 5]
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+HEAVY_MODULES = ['pandas', 'nibabel', 'matplotlib', 'cv2', 'tensorflow', 'nrrd']
+
+SCRIPT = """
+import sys, time, json
+t = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - t
+print(json.dumps({{'elapsed': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(statement, repeat):
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)])
+        results.append(json.loads(output))
+    return min(r['elapsed'] for r in results), results[0]['heavy']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget_ms', help='Budget for a cold "import barbell2_bodycomp" (default: 50)', default=50.0, type=float)
+    parser.add_argument('--convert_budget_ms', help='Budget for importing Tag2Numpy (default: 500)', default=500.0, type=float)
+    parser.add_argument('--repeat', help='Number of fresh interpreters per statement (default: 5)', default=5, type=int)
+    args = parser.parse_args()
+    checks = [
+        ('import barbell2_bodycomp', args.budget_ms),
+        ('from barbell2_bodycomp.convert import Tag2Numpy', args.convert_budget_ms),
+    ]
+    failed = False
+    for statement, budget_ms in checks:
+        elapsed, heavy = measure(statement, args.repeat)
+        ok = elapsed * 1000.0 <= budget_ms and len(heavy) == 0
+        failed = failed or not ok
+        print(f'{"OK  " if ok else "FAIL"} {statement}: {elapsed * 1000.0:.1f} ms (budget {budget_ms:.0f} ms), '
+              f'heavy modules imported: {heavy}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
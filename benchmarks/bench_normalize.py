@@ -0,0 +1,56 @@
+""" Compares the per-slice MuscleFatSegmentator.normalize loop used to build a model input batch
+with MuscleFatSegmentator.normalize_batch on an (N, H, W) stack and checks that the float32
+batches are identical, for int16 (integral rescale) and float32 (non-integral rescale) images.
+
+Usage: python benchmarks/bench_normalize.py [--batch_size 32] [--repeats 10] [--min_bound -200] [--max_bound 200]
+"""
+import time
+import argparse
+import numpy as np
+
+from barbell2_bodycomp.seg import MuscleFatSegmentator
+
+
+def normalize_loop(segmentator, images, min_bound, max_bound):
+    batch = np.empty((len(images), *images[0].shape, 1), dtype=np.float32)
+    for i, image in enumerate(images):
+        batch[i, ..., 0] = segmentator.normalize(image, min_bound, max_bound)
+    return batch
+
+
+def normalize_batch(segmentator, images, min_bound, max_bound):
+    batch = np.empty((len(images), *images[0].shape, 1), dtype=np.float32)
+    segmentator.normalize_batch(images, min_bound, max_bound, out=batch[..., 0])
+    return batch
+
+
+def measure(function, segmentator, images, min_bound, max_bound, repeats):
+    result = function(segmentator, images, min_bound, max_bound)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(segmentator, images, min_bound, max_bound)
+    return result, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', help='Number of 512x512 images (default: 32)', default=32, type=int)
+    parser.add_argument('--repeats', help='Number of repeats (default: 10)', default=10, type=int)
+    parser.add_argument('--min_bound', help='Lower HU bound (default: -200)', default=-200, type=int)
+    parser.add_argument('--max_bound', help='Upper HU bound (default: 200)', default=200, type=int)
+    args = parser.parse_args()
+    segmentator = MuscleFatSegmentator()
+    hu = np.random.randint(-1024, 2000, (args.batch_size, 512, 512))
+    for name, images in [
+        ('int16', hu.astype(np.int16)),
+        ('float32', (hu * 0.5 - 0.25).astype(np.float32)),
+    ]:
+        reference, elapsed_loop = measure(normalize_loop, segmentator, images, args.min_bound, args.max_bound, args.repeats)
+        result, elapsed_batch = measure(normalize_batch, segmentator, images, args.min_bound, args.max_bound, args.repeats)
+        print(f'{args.batch_size} x 512x512 {name}')
+        print(f'   normalize per slice: {elapsed_loop * 1000:.1f} ms')
+        print(f'   normalize_batch: {elapsed_batch * 1000:.1f} ms, identical={np.array_equal(reference, result)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Measures peak memory (tracemalloc) and time per 512x512 slice for HU rescaling and windowing:
+the previous slope * pixels + intercept followed by apply_window with temporaries, against
+utils.rescale_pixels with automatic dtype and in-place windowing into a reused float32 buffer.
+
+Usage: python benchmarks/bench_rescale_memory.py [--nr_slices 200] [--slope 1] [--intercept -1024]
+"""
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+from barbell2_bodycomp.utils import apply_window, rescale_pixels
+
+WINDOW = (400, 50)
+
+
+def rescale_and_window_previous(pixels, slope, intercept, out=None):
+    result = slope * pixels + intercept
+    result = (result - WINDOW[1] + 0.5 * WINDOW[0]) / WINDOW[0]
+    result[result < 0] = 0
+    result[result > 1] = 1
+    return result
+
+
+def rescale_only_previous(pixels, slope, intercept, out=None):
+    return slope * pixels + intercept
+
+
+def rescale_and_window(pixels, slope, intercept, out=None):
+    rescale_pixels(pixels, slope, intercept, out=out)
+    return apply_window(out, WINDOW, out=out)
+
+
+def rescale_only(pixels, slope, intercept, out=None):
+    return rescale_pixels(pixels, slope, intercept, out=out)
+
+
+def measure(function, slices, slope, intercept, out):
+    function(slices[0], slope, intercept, out)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for pixels in slices:
+        function(pixels, slope, intercept, out)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return peak, elapsed / len(slices)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nr_slices', help='Number of slices (default: 200)', default=200, type=int)
+    parser.add_argument('--slope', help='Rescale slope (default: 1)', default=1.0, type=float)
+    parser.add_argument('--intercept', help='Rescale intercept (default: -1024)', default=-1024.0, type=float)
+    args = parser.parse_args()
+    slices = np.random.randint(0, 3000, (args.nr_slices, 512, 512)).astype(np.uint16)
+    hu_buffer = np.empty((512, 512), dtype=rescale_pixels(slices[0], args.slope, args.intercept).dtype)
+    window_buffer = np.empty((512, 512), dtype=np.float32)
+    print(f'{args.nr_slices} slices of 512x512 uint16, slope={args.slope}, intercept={args.intercept}')
+    for name, function, out in [
+        ('rescale (previous)', rescale_only_previous, None),
+        (f'rescale ({hu_buffer.dtype}, out=)', rescale_only, hu_buffer),
+        ('rescale + window (previous)', rescale_and_window_previous, None),
+        ('rescale + window (float32, out=)', rescale_and_window, window_buffer),
+    ]:
+        peak, elapsed = measure(function, slices, args.slope, args.intercept, out)
+        print(f'{name:>34}: peak {peak / 1024 ** 2:.2f} MB, {elapsed * 1000:.2f} ms per slice')
+    identical = np.allclose(
+        rescale_and_window_previous(slices[0], args.slope, args.intercept),
+        rescale_and_window(slices[0], args.slope, args.intercept, window_buffer), atol=1e-6)
+    print(f'results identical (float32 tolerance): {identical}')
+
+
+if __name__ == '__main__':
+    main()
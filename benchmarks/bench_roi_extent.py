@@ -0,0 +1,65 @@
+""" Compares latency and peak memory of SliceSelector.get_min_max_slice_idx with the previous
+implementation (get_fdata() plus per-slice np.unique) on a synthetic full-body-sized vertebra mask.
+
+Usage: python benchmarks/bench_roi_extent.py [--shape 512,512,600] [--uncompressed]
+"""
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import nibabel
+
+from barbell2_bodycomp.selectslice import SliceSelector
+
+
+def get_min_max_slice_idx_reference(roi):
+    roi_data = roi.get_fdata()
+    nr_slices = roi_data.shape[2]
+    i_min = -1
+    for i in range(nr_slices):
+        if 1 in np.unique(roi_data[:, :, i]):
+            i_min = i
+            break
+    i_max = -1
+    for i in range(nr_slices):
+        if 1 in np.unique(roi_data[:, :, nr_slices - i - 1]):
+            i_max = nr_slices - i
+            break
+    return i_min, i_max
+
+
+def measure(f, file_path):
+    roi = nibabel.load(file_path)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f(roi)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', help='Mask shape (default: 512,512,600)', default='512,512,600')
+    parser.add_argument(
+        '--uncompressed', help='Write mask as .nii instead of .nii.gz (as written by TotalSegmentator)', action='store_true')
+    args = parser.parse_args()
+    shape = tuple(int(x) for x in args.shape.split(','))
+    mask = np.zeros(shape, dtype=np.uint8)
+    z0, z1 = int(shape[2] * 0.40), int(shape[2] * 0.45)
+    mask[shape[0] // 2 - 30:shape[0] // 2 + 30, shape[1] // 2:shape[1] // 2 + 50, z0:z1] = 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'vertebrae_L3.nii' if args.uncompressed else 'vertebrae_L3.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(mask, np.eye(4)), file_path)
+        del mask
+        for name, f in [('reference', get_min_max_slice_idx_reference), ('slabs', SliceSelector.get_min_max_slice_idx)]:
+            result, elapsed, peak = measure(f, file_path)
+            print(f'{name:>9}: {result} in {elapsed:.3f}s, peak memory {peak / 1024 / 1024:.1f} MB')
+        print(f'expected: ({z0}, {z1})')
+
+
+if __name__ == '__main__':
+    main()
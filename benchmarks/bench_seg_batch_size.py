@@ -0,0 +1,52 @@
+""" Compares MuscleFatSegmentator throughput for different batch sizes and checks that
+ARGMAX and PROBABILITIES outputs are identical to those of batch size 1.
+
+Usage: python benchmarks/bench_seg_batch_size.py --model_dir <dir> --dicom_dir <dir> [--batch_sizes 1,8,32]
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from barbell2_bodycomp.seg import MuscleFatSegmentator
+
+
+def run(model_files, input_files, batch_size, mode, output_directory):
+    segmentator = MuscleFatSegmentator()
+    segmentator.input_files = input_files
+    segmentator.model_files = model_files
+    segmentator.mode = mode
+    segmentator.batch_size = batch_size
+    segmentator.output_directory = output_directory
+    start = time.perf_counter()
+    output_files = segmentator.execute()
+    return output_files, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', help='Directory containing model.zip, contour_model.zip and params.json')
+    parser.add_argument('--dicom_dir', help='Directory containing L3 DICOM images')
+    parser.add_argument('--batch_sizes', help='Comma-separated batch sizes (default: 1,8,32)', default='1,8,32')
+    args = parser.parse_args()
+    model_files = [os.path.join(args.model_dir, f) for f in ['model.zip', 'contour_model.zip', 'params.json']]
+    model_files = [f for f in model_files if os.path.isfile(f)]
+    input_files = sorted([os.path.join(args.dicom_dir, f) for f in os.listdir(args.dicom_dir)])
+    batch_sizes = [int(x) for x in args.batch_sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode, mode_name in [(MuscleFatSegmentator.ARGMAX, 'ARGMAX'), (MuscleFatSegmentator.PROBABILITIES, 'PROBABILITIES')]:
+            reference = None
+            for batch_size in batch_sizes:
+                output_directory = os.path.join(tmp_dir, f'{mode_name}_{batch_size}')
+                output_files, elapsed = run(model_files, input_files, batch_size, mode, output_directory)
+                outputs = [np.load(f) for f in output_files]
+                if reference is None:
+                    reference = outputs
+                identical = len(outputs) == len(reference) and all(np.array_equal(a, b) for a, b in zip(outputs, reference))
+                print(f'{mode_name:>13} batch_size={batch_size:<3} {len(output_files)} slices in {elapsed:.2f}s '
+                      f'({len(output_files) / elapsed:.1f} slices/s), identical={identical}')
+
+
+if __name__ == '__main__':
+    main()
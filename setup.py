@@ -47,6 +47,9 @@ setup(
         'console_scripts': [
             'dcm2raw=barbell2_bodycomp.convert.dcm2raw:main',
             'npy2nifti=barbell2_bodycomp.convert.npy2nifti:main',
+            'npy2png=barbell2_bodycomp.convert.npy2png:main',
+            'segserver=barbell2_bodycomp.segserver:main',
+            'segstore=barbell2_bodycomp.segstore:main',
         ],
     },
     test_suite='tests',
@@ -0,0 +1,23 @@
+import numpy as np
+
+from barbell2_bodycomp.calculator import BodyCompositionCalculator
+
+
+def test_calculate_metrics_hu_areas():
+    rng = np.random.default_rng(0)
+    image = rng.integers(-300, 300, (64, 64)).astype(np.float32)
+    labels = rng.choice(np.array([0, 1, 5, 7], dtype=np.uint8), (64, 64))
+    pixel_spacing = (0.8, 0.5)
+    pixel_area = 0.8 * 0.5 / 100.0
+    metrics = BodyCompositionCalculator.calculate_metrics(image, labels, pixel_spacing)
+    muscle = labels == BodyCompositionCalculator.MUSCLE
+    assert metrics['muscle_pixel_count'] == np.count_nonzero(muscle)
+    assert np.isclose(metrics['muscle_area'], np.count_nonzero(muscle) * pixel_area)
+    imat = muscle & (image >= -190) & (image <= -30)
+    assert np.isclose(metrics['imat_area'], np.count_nonzero(imat) * pixel_area)
+    muscle_hu = muscle & (image >= -29) & (image <= 150)
+    assert np.isclose(metrics['muscle_hu_area'], np.count_nonzero(muscle_hu) * pixel_area)
+    sat_hu = (labels == BodyCompositionCalculator.SAT) & (image >= -190) & (image <= -30)
+    assert np.isclose(metrics['sat_hu_area'], np.count_nonzero(sat_hu) * pixel_area)
+    metrics = BodyCompositionCalculator.calculate_metrics(image, labels, pixel_spacing, hu_ranges={})
+    assert 'imat_area' not in metrics
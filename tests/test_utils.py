@@ -0,0 +1,23 @@
+import numpy as np
+
+from barbell2_bodycomp.utils import get_tag_pixels, update_labels
+
+
+def write_tag_file(f_path, labels):
+    header = f'version: 1 width: {labels.shape[1]} height: {labels.shape[0]} '.encode('ASCII')
+    with open(f_path, 'wb') as f:
+        f.write(header + b'\x0c' + labels.astype(np.uint8).tobytes())
+
+
+def test_update_labels_on_tag_pixels(tmp_path):
+    labels = np.array([[0, 1, 2], [5, 7, 12], [14, 1, 0]], dtype=np.uint8)
+    f_path = str(tmp_path / 'slice.tag')
+    write_tag_file(f_path, labels)
+    expected = np.array([[0, 1, 0], [5, 7, 0], [0, 1, 0]], dtype=np.uint8)
+    pixels = get_tag_pixels(f_path)
+    assert pixels.flags.writeable
+    np.testing.assert_array_equal(update_labels(pixels), expected)
+    # Read-only memory maps are remapped into a new array
+    pixels = get_tag_pixels(f_path, mmap_mode='r')
+    np.testing.assert_array_equal(update_labels(pixels), expected)
+    np.testing.assert_array_equal(pixels, labels)